@@ -3,102 +3,209 @@
 
 
 from __future__ import annotations
+import hmac
 from loguru import logger
-from sqlmodel import Session, select, delete
-from string import ascii_lowercase, ascii_uppercase
-from random import sample
+from sqlmodel import select, delete
 from fastapi import Path, Query, Depends, HTTPException
 
 from main import app
 from auth import *
-from db import engine
+from db import engine, AsyncSession, get_session
 from models import *
+from keys import SIGNING_KEY, SIGNING_ALGORITHM
+from usage import LastUsedBuffer
+from keygen import add_apikey, parse_apikey, hash_apikey, masked_apikey, LEGACY_PREFIX
+from paging import LimitQuery, CursorQuery, paginate, page
+from export import ndjson_response
 
 
-JWT_RSA_PUBLIC_KEY = os.environ['JIGGY_JWT_RSA_PUBLIC_KEY']
-JWT_RSA_PRIVATE_KEY = os.environ['JIGGY_JWT_RSA_PRIVATE_KEY']
-JWT_ISSUER = "Jiggy.AI"
+# max number of team memberships embedded in a JWT; larger memberships are left out of the token
+JWT_TEAMS_CLAIM_MAX = int(os.environ.get('JIGGY_JWT_TEAMS_CLAIM_MAX', 50))
+
+# apikey.last_used is written behind the /auth requests that use the key
+last_used_buffer = LastUsedBuffer(engine,
+                                  interval  = int(os.environ.get('JIGGY_APIKEY_LAST_USED_FLUSH', 10)),
+                                  precision = int(os.environ.get('JIGGY_APIKEY_LAST_USED_PRECISION', 60)))
+last_used_buffer.start()
+
+
+@app.on_event('shutdown')
+def flush_last_used():
+    last_used_buffer.flush()
+
+
+async def lookup_apikey(session, key):
+    """
+    return the ApiKey for the specified API key, or None if it is not valid
+    """
+    key_id = parse_apikey(key)
+    if key_id is not None:
+        apikey = await session.get(ApiKey, key_id)
+        if apikey and hmac.compare_digest(apikey.key, hash_apikey(key)):
+            return apikey
+        return None
+    if key.startswith(LEGACY_PREFIX):
+        return (await session.exec(select(ApiKey).where(ApiKey.key == key))).first()
+    # malformed or forged key
+    return None
+
+
+# lifetimes of the tokens issued by /auth; a refresh token can be exchanged for a new access token
+# at /auth/refresh until it expires, without presenting the API key again.
+ACCESS_TOKEN_TTL = int(os.environ.get('JIGGY_ACCESS_TOKEN_TTL', 15*60))
+
+
+def sign_tokens(*claims):
+    """
+    return the signed JWT for each of the claims
+    """
+    return [jwt.encode(c, SIGNING_KEY, algorithm=SIGNING_ALGORITHM, headers={'kid': ACTIVE_KID}) for c in claims]
+
+
+async def access_token_claims(session, user_id, include_teams, iat):
+    """
+    return the claims of an access token for the user, including their team memberships if requested
+    """
+    token_info = {'iat':  iat,
+                  'exp':  iat + ACCESS_TOKEN_TTL,
+                  'iss':  JWT_ISSUER,
+                  'sub':  user_id}
+
+    if include_teams:
+        roles = await team_roles(session, user_id)
+        if len(roles) <= JWT_TEAMS_CLAIM_MAX:
+            token_info['teams'] = {str(team_id): role.value for team_id, role in roles.items()}
+        else:
+            logger.info(f"user {user_id} has too many teams to embed in the JWT")
+    return token_info
 
 
 @app.post('/auth', response_model=Jwt)
-def post_auth(body: AuthRequest = ...) -> Jwt:
+async def post_auth(body: AuthRequest = ...,
+                    session: AsyncSession = Depends(get_session)) -> Jwt:
     """
-    trade an API key for a JWT Bearer token that can be used to authenticate subsequent API operations.
+    trade an API key for a JWT Bearer token that can be used to authenticate subsequent API operations,
+    and a refresh token that can be traded for new Bearer tokens at /auth/refresh.
     """
-    with Session(engine) as session:    
-        apikey = session.exec(select(ApiKey).where(ApiKey.key == body.key)).first()
-        if not apikey:
-            logger.info("invalid API key")
-            raise HTTPException(status_code=401, detail="Invalid Key")
+    apikey = await lookup_apikey(session, body.key)
+    if not apikey:
+        logger.info("invalid API key")
+        raise HTTPException(status_code=401, detail="Invalid Key")
+
+    last_used_buffer.record(apikey)
+
+    iat = int(time())        
+    token_info = await access_token_claims(session, apikey.user_id, body.include_teams, iat)
+    refresh_info = {'iat':   iat,
+                    'exp':   iat + REFRESH_TOKEN_TTL,
+                    'iss':   JWT_ISSUER,
+                    'aud':   REFRESH_AUDIENCE,
+                    'sub':   apikey.user_id,
+                    'akid':  apikey.id,
+                    'teams': body.include_teams}
+
+    token, refresh_token = await run_in_threadpool(sign_tokens, token_info, refresh_info)
+    return Jwt(jwt=token, expires_in=ACCESS_TOKEN_TTL, refresh_token=refresh_token)
+
+
+@app.post('/auth/refresh', response_model=Jwt)
+async def post_auth_refresh(body: RefreshRequest = ...,
+                            session: AsyncSession = Depends(get_session)) -> Jwt:
+    """
+    trade a refresh token from /auth for a new JWT Bearer token.
+    """
+    refresh_info = await verified_refresh_token(body.refresh_token, session)
+    token_info = await access_token_claims(session, refresh_info['sub'], refresh_info.get('teams'), int(time()))
+    token, = await run_in_threadpool(sign_tokens, token_info)
+    return Jwt(jwt=token, expires_in=ACCESS_TOKEN_TTL)
 
-        apikey.last_used = time()
-        session.add(apikey)
-        session.commit()
-        
-        iat = int(time())        
-        token_info = {'iat':  iat,
-                      'exp':  iat + 15*60, 
-                      'iss':  JWT_ISSUER,
-                      'sub':  apikey.user_id}
 
-        token = jwt.encode(token_info, JWT_RSA_PRIVATE_KEY, algorithm='RS256')
-        return Jwt(jwt=token)
+@app.post('/tokens/introspect', response_model=TokenIntrospectResponse)
+async def post_tokens_introspect(token: str = Depends(token_auth_scheme),
+                                 body: TokenIntrospectRequest = ...,
+                                 session: AsyncSession = Depends(get_session)) -> TokenIntrospectResponse:
+    """
+    verify a batch of bearer tokens presented to a downstream service and return the user, current
+    team roles and expiry of each.  The caller authenticates with its own bearer token.
+    """
+    await verified_user_id(token, session)
+    results = await introspect_tokens(body.tokens, session)
+    items = []
+    for credentials in body.tokens:
+        result = results[credentials]
+        if isinstance(result, str):
+            items.append(TokenIntrospection(active=False, error=result))
+        else:
+            user_id, teams, exp = result
+            items.append(TokenIntrospection(active=True, user_id=user_id, teams=teams, exp=exp))
+    return TokenIntrospectResponse(items=items)
 
 
     
-def create_apikey(user_id, description=None):
+async def create_apikey(session, user_id, description=None):
     """
-    create an API key for the specified username
+    create an API key for the specified username.
+    The returned ApiKey contains the key itself; only its hash is stored.
     """
-    key = ApiKey(key = "jgy-" + "".join([sample(ascii_lowercase+ascii_uppercase,1)[0] for x in range(42)]),
-                 user_id = user_id,
-                 description = description)
-    
-    with Session(engine) as session:
-        session.add(key)
-        session.commit()
-        session.refresh(key)
-    return ApiKey(**key.dict())
+    apikey, key = await add_apikey(session, user_id, description)
+    await session.commit()
+    return ApiKey(**{**apikey.dict(), 'key': key})
     
 
 @app.post("/apikey", response_model=ApiKey)
-def post_apikey(token: str = Depends(token_auth_scheme),
-                body: ApiKeyRequest = ...) -> ApiKey:
+async def post_apikey(token: str = Depends(token_auth_scheme),
+                      body: ApiKeyRequest = ...,
+                      session: AsyncSession = Depends(get_session)) -> ApiKey:
     """
     create an API key for an authenticated user
     """
-    user_id = verified_user_id(token)
-    return create_apikey(user_id, body.description)
+    user_id = await verified_user_id(token, session)
+    return await create_apikey(session, user_id, body.description)
 
 
 
 @app.get("/apikey", response_model=AllApiKeyResponse)
-def get_apikey(token: str = Depends(token_auth_scheme)) -> AllApiKeyResponse:
+async def get_apikey(token: str = Depends(token_auth_scheme),
+                     limit:  Optional[int] = LimitQuery,
+                     cursor: Optional[str] = CursorQuery,
+                     session: AsyncSession = Depends(get_session)) -> AllApiKeyResponse:
+    """
+    return the user's API keys, a page at a time if a limit is specified
+    """
+    user_id = await verified_user_id(token, session)
+    statement = paginate(select(ApiKey).where(ApiKey.user_id == user_id), ApiKey.id, limit, cursor)
+    keys, next_cursor = page((await session.exec(statement)).all(), limit, lambda k: k.id)
+    keys = [ApiKey(**{**k.dict(), 'key': masked_apikey(k)}) for k in keys]
+    return AllApiKeyResponse(items=keys, next_cursor=next_cursor)
+
+
+@app.get('/apikey/export')
+async def get_apikey_export(token: str = Depends(token_auth_scheme),
+                            session: AsyncSession = Depends(get_session)):
     """
-    return all of the user's API keys
+    Stream all of the user's API keys as newline delimited ApiKey JSON
     """
-    user_id = verified_user_id(token)
-    with Session(engine) as session:
-        statement = select(ApiKey).where(ApiKey.user_id == user_id)
-        keys = list(session.exec(statement))
-        return AllApiKeyResponse(items=keys)
+    user_id = await verified_user_id(token, session)
+    statement = select(ApiKey).where(ApiKey.user_id == user_id).order_by(ApiKey.id)
+    return ndjson_response(session, statement, lambda row: ApiKey(**{**row[0].dict(), 'key': masked_apikey(row[0])}))
 
 
 
 
 @app.delete('/apikey/{api_key_id}')
-def delete_apikey(token: str = Depends(token_auth_scheme),
-                  api_key_id: str = Path(...)):
+async def delete_apikey(token: str = Depends(token_auth_scheme),
+                        api_key_id: int = Path(...),
+                        session: AsyncSession = Depends(get_session)):
     """
     delete the specified api key.
     """
-    user_id = verified_user_id(token)
+    user_id = await verified_user_id(token, session)
     
-    with Session(engine) as session:    
-        apikey = session.get(ApiKey, api_key_id)
-        if not apikey or apikey.user_id != user_id:
-            raise HTTPException(status_code=404, detail="Invalid Key")
-        session.delete(apikey)
-        session.commit()
+    apikey = await session.get(ApiKey, api_key_id)
+    if not apikey or apikey.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Invalid Key")
+    await session.delete(apikey)
+    await session.commit()
+    revoke_apikey(api_key_id)
 
 
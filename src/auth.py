@@ -1,11 +1,19 @@
 
-from fastapi import HTTPException
+from fastapi import HTTPException, Path, Depends
+from fastapi.concurrency import run_in_threadpool
 import jwt
 import os
-from sqlmodel import Session, select, or_
+from typing import NamedTuple
+from hashlib import sha256
+from time import time
+from sqlmodel import select, or_
 from fastapi.security import HTTPBearer 
 
-from db import engine
+from db import engine, pin_user, replica_engines, write_listeners, AsyncSession, get_session
+from cache import TTLCache
+from bus import create_bus
+from jwks import JWKSManager
+from keys import ACTIVE_KID, verification_keys, key_algorithm
 
 from models import *
 
@@ -20,47 +28,58 @@ ALGORITHMS = ["RS256"]
 ISSUER = "https://"+DOMAIN+"/"
 
 jwks_url = 'https://%s/.well-known/jwks.json' % DOMAIN
-jwks_client = jwt.PyJWKClient(jwks_url)
+jwks_client = JWKSManager(jwks_url,
+                          seed                 = os.environ.get('JIGGY_AUTH0_JWKS'),
+                          seed_file            = os.environ.get('JIGGY_AUTH0_JWKS_FILE'),
+                          refresh_interval     = int(os.environ.get('JIGGY_AUTH0_JWKS_REFRESH', 3600)),
+                          min_refetch_interval = int(os.environ.get('JIGGY_AUTH0_JWKS_MIN_REFETCH', 30)))
+jwks_client.start()
 
 
 
-JWT_RSA_PUBLIC_KEY = os.environ['JIGGY_JWT_RSA_PUBLIC_KEY']
 JWT_ISSUER = "Jiggy.AI"
 
 
+# verified tokens are cached until their own 'exp' to avoid repeating the signature verification
+# for every request made with the same token.  set JIGGY_TOKEN_CACHE_SIZE=0 to disable.
+TOKEN_CACHE_SIZE = int(os.environ.get('JIGGY_TOKEN_CACHE_SIZE', 10000))
 
-def verify_jiggy_api_token(credentials):
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE)   # sha256(token) -> (user_id, exp)
+
+
+def verify_jiggy_api_token(credentials, header=None):
     """Perform Jiggy API token verification using PyJWT.  raise HTTPException on error"""
 
-    # This gets the 'kid' from the passed token credentials
-    try:
-        signing_key = JWT_RSA_PUBLIC_KEY
-    except jwt.exceptions.PyJWKClientError as error:
-        raise HTTPException(status_code=401, detail=str(error))
-    except jwt.exceptions.DecodeError as error:
-        raise HTTPException(status_code=401, detail=str(error))
-    except Exception as error:
-        raise HTTPException(status_code=401, detail=str(error))
-    
+    # select the verification key by the token's 'kid'; tokens issued before kids were used have none
+    if header is None:
+        header = unverified_header(credentials)
+    kid = header.get('kid', ACTIVE_KID)
+    if not isinstance(kid, str):
+        raise HTTPException(status_code=401, detail="Invalid kid")
+    signing_key = verification_keys.get(kid)
+    if signing_key is None:
+        raise HTTPException(status_code=401, detail=f"Unknown signing key {kid}")
+
     try:
         payload = jwt.decode(credentials,
                              signing_key,
-                             algorithms=ALGORITHMS,
+                             algorithms=[key_algorithm(signing_key)],
                              issuer=JWT_ISSUER)
     except Exception as e:
         raise HTTPException(status_code=401, detail=str(e))
     return payload
 
     
-def verify_auth0_token(credentials):
+def verify_auth0_token(credentials, header=None):
     """Perform auth0 token verification using PyJWT.  raise HTTPException on error"""
-    # This gets the 'kid' from the passed token
+    if header is None:
+        header = unverified_header(credentials)
+    if not isinstance(header.get('kid'), str):
+        raise HTTPException(status_code=401, detail="Invalid kid")
     try:
-        signing_key = jwks_client.get_signing_key_from_jwt(credentials).key
+        signing_key = jwks_client.get_signing_key(header.get('kid')).key
     except jwt.exceptions.PyJWKClientError as error:
         raise HTTPException(status_code=401, detail=str(error))
-    except jwt.exceptions.DecodeError as error:
-        raise HTTPException(status_code=401, detail=str(error))
     except Exception as error:
         raise HTTPException(status_code=401, detail=str(error))
     
@@ -75,46 +94,380 @@ def verify_auth0_token(credentials):
     return payload
 
 
+def unverified_header(credentials):
+    """return the unverified header of the token.  raise HTTPException on error"""
+    try:
+        return jwt.get_unverified_header(credentials)
+    except jwt.exceptions.InvalidTokenError as error:
+        raise HTTPException(status_code=401, detail=str(error))
+
+
+# issuer -> function(credentials, header) that verifies a token from that issuer and returns its payload
+token_verifiers = {JWT_ISSUER: verify_jiggy_api_token,
+                   ISSUER:     verify_auth0_token}
 
-def verified_user_id(token):
+
+def verify_token(credentials):
     """
-    verify the supplied token and return the associated user_id
+    verify the token using the verifier registered for its (unverified) issuer and return the token payload.
+    raise HTTPException on error
     """
     try:
-        # first see if it is a token we issued from an API key
-        user_id = verify_jiggy_api_token(token.credentials)['sub']
-    except:
-        # check if it is an auth0-issued token
-        token_payload = verify_auth0_token(token.credentials)
+        unverified = jwt.api_jwt.decode_complete(credentials, options={'verify_signature': False})
+    except jwt.exceptions.DecodeError as error:
+        raise HTTPException(status_code=401, detail=str(error))
+    issuer = unverified['payload'].get('iss')
+    verifier = token_verifiers.get(issuer) if isinstance(issuer, str) else None
+    if verifier is None:
+        raise HTTPException(status_code=401, detail="Unknown token issuer")
+    return verifier(credentials, unverified['header'])
+
+
+def token_digest(credentials):
+    return sha256(credentials.encode()).digest()
+
+
+async def verified_token(token, session):
+    """
+    verify the supplied token and return the associated user_id.
+    A teams claim in the token is for downstream services and is not used here.
+    """
+    digest = token_digest(token.credentials)
+    cached = token_cache.get(digest)
+    if cached is not None:
+        user_id, exp = cached
+        session.info['user_id'] = user_id   # replica routing
+        return user_id
+    # signature verification (and a JWKS fetch for an unknown kid) must not block the event loop
+    token_payload = await run_in_threadpool(verify_token, token.credentials)
+    if token_payload['iss'] == JWT_ISSUER:
+        # a token we issued from an API key
+        user_id = token_payload['sub']
+    else:
+        # an auth0-issued token
         auth0_id = token_payload['sub']
-        with Session(engine) as session:
-            statement = select(User).where(User.auth0_userid == auth0_id)
-            user = session.exec(statement).first()
-            if user is None:
-                raise HTTPException(status_code=400, detail="No user object found for auth0 subject. Must first create user.")
-            user_id = user.id
+        statement = select(User).where(User.auth0_userid == auth0_id)
+        user = (await session.exec(statement)).first()
+        if user is None and session.info.get('read_only') and replica_engines:
+            # a user who just signed up may not have replicated yet; serve the request from the primary
+            session.info['read_only'] = False
+            user = (await session.exec(statement)).first()
+            if user is not None:
+                pin_user(user.id)
+        if user is None:
+            raise HTTPException(status_code=400, detail="No user object found for auth0 subject. Must first create user.")
+        user_id = user.id
+    token_cache.set(digest, (user_id, token_payload['exp']), expires_at=token_payload['exp'])
+    session.info['user_id'] = user_id   # replica routing
     return user_id
 
 
+async def verified_user_id(token, session):
+    """
+    verify the supplied token and return the associated user_id
+    """
+    return await verified_token(token, session)
+
+
+# each user's team memberships and roles are cached for a short time; every mutation of a user's
+# memberships must call invalidate_user_teams() so that authorization never relies on a stale map.
+TEAM_CACHE_SIZE = int(os.environ.get('JIGGY_TEAM_CACHE_SIZE', 10000))
+TEAM_CACHE_TTL  = int(os.environ.get('JIGGY_TEAM_CACHE_TTL', 300))
+
+user_teams = TTLCache(maxsize=TEAM_CACHE_SIZE, ttl=TEAM_CACHE_TTL)   # user_id -> {team_id: TeamRole}
+
+
+# Refresh tokens are issued by /auth along with access tokens and exchanged for new access tokens
+# at /auth/refresh.  They are JWTs for REFRESH_AUDIENCE, so they are rejected as access tokens
+# (which have no audience) and access tokens are rejected as refresh tokens.
+REFRESH_AUDIENCE  = "Jiggy.AI/auth/refresh"
+REFRESH_TOKEN_TTL = int(os.environ.get('JIGGY_REFRESH_TOKEN_TTL', 30*24*3600))
+
+# Deleted API keys and users are published on the bus and remembered until every refresh token
+# issued before the deletion has expired.  A worker has heard every revocation since its revocation
+# epoch (its start or the last bus reconnect), so a refresh token issued since then is checked in
+# memory only.  The key of an older refresh token is looked up in the database once per epoch.
+REVOCATION_CACHE_SIZE = 100000
+
+revoked_apikeys  = TTLCache(maxsize=REVOCATION_CACHE_SIZE, ttl=REFRESH_TOKEN_TTL)   # apikey id -> True
+revoked_users    = TTLCache(maxsize=REVOCATION_CACHE_SIZE, ttl=REFRESH_TOKEN_TTL)   # user_id -> True
+verified_apikeys = TTLCache(maxsize=REVOCATION_CACHE_SIZE)     # apikey id -> epoch in which it was found in the db
+revocation_epoch = time()
+
+
+def _new_revocation_epoch():
+    global revocation_epoch
+    revocation_epoch = time()
+    verified_apikeys.clear()
+
+
+def _revoke(revoked, key):
+    if len(revoked) >= REVOCATION_CACHE_SIZE:
+        # an older revocation is about to be evicted; recheck older tokens against the database
+        _new_revocation_epoch()
+    revoked.set(key, True)
+
+
+def _revoke_apikey(apikey_id):
+    _revoke(revoked_apikeys, apikey_id)
+    verified_apikeys.pop(apikey_id)
+
+
+def verify_refresh_token(credentials):
+    """
+    verify the signature, audience and expiry of a refresh token and return its payload.
+    raise HTTPException on error
+    """
+    header = unverified_header(credentials)
+    signing_key = verification_keys.get(header.get('kid', ACTIVE_KID))
+    if signing_key is None:
+        raise HTTPException(status_code=401, detail="Unknown signing key")
+    try:
+        return jwt.decode(credentials,
+                          signing_key,
+                          algorithms=[key_algorithm(signing_key)],
+                          audience=REFRESH_AUDIENCE,
+                          issuer=JWT_ISSUER)
+    except Exception as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
+
+async def verified_refresh_token(credentials, session):
+    """
+    verify the refresh token and that neither its API key nor its user has been deleted.
+    return the token payload.
+    """
+    payload = await run_in_threadpool(verify_refresh_token, credentials)
+    user_id, apikey_id = payload['sub'], payload['akid']
+    if revoked_users.get(user_id) is not None or revoked_apikeys.get(apikey_id) is not None:
+        raise HTTPException(status_code=401, detail="Refresh token revoked")
+    epoch = revocation_epoch
+    if payload['iat'] < epoch and verified_apikeys.get(apikey_id) != epoch:
+        apikey = await session.get(ApiKey, apikey_id)
+        if apikey is None or apikey.user_id != user_id:
+            raise HTTPException(status_code=401, detail="Refresh token revoked")
+        verified_apikeys.set(apikey_id, epoch)
+    return payload
+
+
+# cache invalidations are published on the bus so that every worker process evicts its copy
+bus = create_bus(engine)
+
+
+def invalidate_user_teams(*user_ids):
+    """
+    drop the cached team memberships of the specified users in all workers
+    """
+    for user_id in user_ids:
+        bus.publish('user_teams', user_id)
+
+
+def invalidate_user(user_id):
+    """
+    drop all cached state of the specified (deleted) user and revoke their refresh tokens in all workers
+    """
+    bus.publish('user', user_id)
+
+
+def invalidate_username(user_id):
+    """
+    drop the cached username of the specified (renamed) user in all workers
+    """
+    bus.publish('username', user_id)
+
+
+def revoke_apikey(apikey_id):
+    """
+    revoke the refresh tokens issued for the specified (deleted) API key in all workers
+    """
+    bus.publish('apikey', apikey_id)
+
+
+def _evict_user_teams(user_id):
+    user_teams.pop(user_id)
+    # the membership change may not have reached the replicas yet
+    pin_user(user_id)
 
 
+def _evict_user(user_id):
+    token_cache.evict_where(lambda cached: cached[0] == user_id)
+    user_teams.pop(user_id)
+    _revoke(revoked_users, user_id)
+    pin_user(user_id)
 
 
-user_teams = {}   # XXX expiring dict or a real cache
+def _publish_pin(user_id):
+    bus.publish('pin', user_id)
 
-def verified_user_id_teams(token):
+
+def _reset_caches():
+    token_cache.clear()
+    user_teams.clear()
+    # revocations may have been missed
+    _new_revocation_epoch()
+
+
+bus.subscribe('user_teams', _evict_user_teams)
+bus.subscribe('user', _evict_user)
+bus.subscribe('apikey', _revoke_apikey)
+bus.on_reset(_reset_caches)
+
+# read your writes: a user's committed changes pin their reads to the primary in every worker.
+# /auth records key usage outside of the request session and so never pins.
+if replica_engines:
+    bus.subscribe('pin', pin_user)
+    write_listeners.append(_publish_pin)
+
+
+async def team_roles(session, user_id):
+    """
+    return the {team_id: role} map of the specified user's memberships
+    """
+    roles = user_teams.get(user_id)
+    if roles is not None:
+        return roles
+    statement = select(TeamMember.team_id, TeamMember.role).where(TeamMember.user_id == user_id)
+    roles = dict(list(await session.exec(statement)))
+    user_teams.set(user_id, roles)
+    return roles
+
+
+async def team_roles_many(session, user_ids):
+    """
+    return {user_id: {team_id: role}} for the specified users, loading uncached users with one query
+    """
+    roles = {}
+    missing = []
+    for user_id in user_ids:
+        cached = user_teams.get(user_id)
+        if cached is not None:
+            roles[user_id] = cached
+        else:
+            missing.append(user_id)
+    if missing:
+        loaded = {user_id: {} for user_id in missing}
+        statement = select(TeamMember.user_id, TeamMember.team_id, TeamMember.role).where(TeamMember.user_id.in_(missing))
+        for user_id, team_id, role in await session.exec(statement):
+            loaded[user_id][team_id] = role
+        for user_id, user_roles in loaded.items():
+            user_teams.set(user_id, user_roles)
+        roles.update(loaded)
+    return roles
+
+
+def _verify_tokens(credentials_list):
+    """
+    verify each token, returning its payload or the HTTPException raised
+    """
+    results = []
+    for credentials in credentials_list:
+        try:
+            results.append(verify_token(credentials))
+        except HTTPException as e:
+            results.append(e)
+    return results
+
+
+async def introspect_tokens(tokens, session):
+    """
+    verify each of the distinct tokens and return {token: (user_id, {team_id: role}, exp)} for valid
+    tokens and {token: error detail} for the others.  Roles are the user's current memberships.
+    Verifications and memberships are taken from the caches where possible; the remaining tokens are
+    verified in a single thread pool call and resolved with at most two queries.
+    """
+    results = {}
+    verified = {}    # token -> (user_id, exp)
+    pending = []
+    for credentials in set(tokens):
+        cached = token_cache.get(token_digest(credentials))
+        if cached is not None:
+            verified[credentials] = cached
+        else:
+            pending.append(credentials)
+
+    auth0_payloads = {}
+    for credentials, payload in zip(pending, await run_in_threadpool(_verify_tokens, pending)):
+        if isinstance(payload, HTTPException):
+            results[credentials] = payload.detail
+        elif payload['iss'] == JWT_ISSUER:
+            token_cache.set(token_digest(credentials), (payload['sub'], payload['exp']), expires_at=payload['exp'])
+            verified[credentials] = (payload['sub'], payload['exp'])
+        else:
+            auth0_payloads[credentials] = payload
+
+    if auth0_payloads:
+        statement = select(User.auth0_userid, User.id).where(User.auth0_userid.in_({p['sub'] for p in auth0_payloads.values()}))
+        user_ids = dict(list(await session.exec(statement)))
+        for credentials, payload in auth0_payloads.items():
+            user_id = user_ids.get(payload['sub'])
+            if user_id is None:
+                results[credentials] = "No user object found for auth0 subject."
+                continue
+            token_cache.set(token_digest(credentials), (user_id, payload['exp']), expires_at=payload['exp'])
+            verified[credentials] = (user_id, payload['exp'])
+
+    roles = await team_roles_many(session, {user_id for user_id, exp in verified.values()})
+    for credentials, (user_id, exp) in verified.items():
+        results[credentials] = (user_id, roles[user_id], exp)
+    return results
+
+
+async def verified_user_id_team_roles(token, session):
+    """
+    verify the supplied token and return the associated user id and {team_id: role} map of the user's memberships.
+    The memberships come from the (invalidated on change) membership cache or database, never from the token:
+    the teams claim is for downstream services and may be stale for the lifetime of the token.
+    """
+    user_id = await verified_token(token, session)
+    return user_id, await team_roles(session, user_id)
+
+
+async def verified_user_id_teams(token, session):
     """
     verify the supplied token and return the associated user id and list of the user's teams_ids
     """
-    user_id = verified_user_id(token)
-    # XXX cache team ids, or put them in the jwt?
-    if user_id in user_teams:
-        return user_id, user_teams[user_id]
-    with Session(engine) as session:        
-        statement = select(TeamMember).where(TeamMember.user_id == user_id)
-        team_ids = [m.team_id for m in session.exec(statement)]
-    user_teams[user_id] = team_ids
-    return user_id, team_ids
+    user_id, roles = await verified_user_id_team_roles(token, session)
+    return user_id, list(roles)
+
+
+class TeamAuthorization(NamedTuple):
+    user_id: int
+    team_id: int
+    role:    TeamRole
+
+
+class TeamRoleRequired:
+    """
+    FastAPI dependency authorizing the caller for the team_id path parameter.
+    Responds 404 if the caller is not a member of the team and 403 if their role is not one of roles
+    (any role if none are specified), otherwise returns the caller's TeamAuthorization.
+    Authorization uses the caller's current memberships, never those embedded in a token.
+    """
+
+    def __init__(self, *roles):
+        self.roles = roles or tuple(TeamRole)
+
+    async def __call__(self,
+                       team_id: int = Path(...),
+                       token: str = Depends(token_auth_scheme),
+                       session: AsyncSession = Depends(get_session)) -> TeamAuthorization:
+        user_id, roles = await verified_user_id_team_roles(token, session)
+        role = roles.get(team_id)
+        if role is None:
+            raise HTTPException(status_code=404, detail="Team not found")
+        if role not in self.roles:
+            raise HTTPException(status_code=403, detail="Insufficient permission.")
+        return TeamAuthorization(user_id, team_id, role)
+
+
+def cache_stats():
+    """
+    return hit/miss statistics for the authentication caches
+    """
+    return {'token_cache': token_cache.stats(),
+            'team_cache':  user_teams.stats(),
+            'revocations': {'apikeys': len(revoked_apikeys), 'users': len(revoked_users), 'epoch': revocation_epoch},
+            'auth0_jwks':  jwks_client.stats()}
 
 
 
@@ -0,0 +1,133 @@
+# Cache invalidation bus
+# Copyright (C) 2022 William S. Kish
+#
+# Each worker process keeps its own in-process caches.  Mutations publish an
+# invalidation event (a topic and a key) on the bus and every subscribed worker
+# evicts the matching entries.
+
+import os
+import json
+import queue
+import select
+import threading
+from collections import defaultdict
+from time import sleep
+from uuid import uuid4
+
+from loguru import logger
+from sqlalchemy import text
+
+
+class LocalBus:
+    """
+    In-process invalidation bus; events are delivered synchronously to the handlers of this process only.
+    Suitable for single worker deployments and tests.
+    """
+
+    def __init__(self):
+        self.handlers = defaultdict(list)   # topic -> [handler(key)]
+        self.reset_handlers = []            # called when events may have been lost
+
+    def subscribe(self, topic, handler):
+        self.handlers[topic].append(handler)
+
+    def on_reset(self, handler):
+        self.reset_handlers.append(handler)
+
+    def publish(self, topic, key):
+        self.deliver(topic, key)
+
+    def deliver(self, topic, key):
+        for handler in self.handlers[topic]:
+            try:
+                handler(key)
+            except Exception as e:
+                logger.exception(e)
+
+    def reset(self):
+        for handler in self.reset_handlers:
+            try:
+                handler()
+            except Exception as e:
+                logger.exception(e)
+
+
+class PostgresBus(LocalBus):
+    """
+    Invalidation bus shared by all workers connected to the same database, using Postgres LISTEN/NOTIFY.
+    Events are delivered locally at publish time and to other workers by background sender and listener
+    threads, so publishing never blocks the caller on the database.
+    """
+    CHANNEL = 'jiggy_invalidate'
+
+    def __init__(self, engine, reconnect_delay=5):
+        super().__init__()
+        self.engine = engine
+        self.reconnect_delay = reconnect_delay
+        self.origin = uuid4().hex
+        self.outbox = queue.Queue()
+        self.listener = threading.Thread(target=self._listen, name='invalidation-bus', daemon=True)
+        self.listener.start()
+        self.sender = threading.Thread(target=self._send, name='invalidation-bus-sender', daemon=True)
+        self.sender.start()
+
+    def publish(self, topic, key):
+        self.deliver(topic, key)
+        self.outbox.put(json.dumps({'topic': topic, 'key': key, 'origin': self.origin}))
+
+    def _send(self):
+        while True:
+            payload = self.outbox.get()
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(text("SELECT pg_notify(:channel, :payload)"),
+                                 {'channel': self.CHANNEL, 'payload': payload})
+            except Exception as e:
+                logger.exception(e)
+
+    def _listen(self):
+        while True:
+            try:
+                conn = self.engine.raw_connection()
+                conn.detach()
+                dbapi_conn = conn.connection
+                dbapi_conn.autocommit = True
+                dbapi_conn.cursor().execute(f"LISTEN {self.CHANNEL}")
+                # notifications published while we were not listening are lost
+                self.reset()
+                logger.info(f"listening for cache invalidations on {self.CHANNEL}")
+                while True:
+                    if select.select([dbapi_conn], [], [], 60) == ([], [], []):
+                        continue
+                    dbapi_conn.poll()
+                    while dbapi_conn.notifies:
+                        self._receive(dbapi_conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.warning(f"invalidation bus listener error: {e}")
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                sleep(self.reconnect_delay)
+
+    def _receive(self, payload):
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            logger.warning(f"invalid invalidation event: {payload}")
+            return
+        if event.get('origin') == self.origin:
+            return
+        self.deliver(event['topic'], event['key'])
+
+
+def create_bus(engine):
+    """
+    create the invalidation bus selected by JIGGY_INVALIDATION_BUS ('local' or 'postgres')
+    """
+    kind = os.environ.get('JIGGY_INVALIDATION_BUS', 'local')
+    if kind == 'postgres':
+        return PostgresBus(engine)
+    if kind == 'local':
+        return LocalBus()
+    raise ValueError(f"Unknown JIGGY_INVALIDATION_BUS {kind}")
@@ -0,0 +1,84 @@
+# In-process caches
+# Copyright (C) 2022 William S. Kish
+
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class TTLCache:
+    """
+    A bounded, thread-safe LRU cache whose entries expire at a per-entry deadline.
+    When the cache is full the least recently used entry is evicted.
+    A maxsize of 0 disables the cache entirely.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl            # default lifetime in seconds for entries set without an explicit expiry
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        if not self.maxsize:
+            return default
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, expires_at=None):
+        """
+        store value under key until expires_at (epoch seconds), or for the default ttl if not specified
+        """
+        if not self.maxsize:
+            return
+        if expires_at is None and self.ttl is not None:
+            expires_at = time() + self.ttl
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def evict_where(self, predicate):
+        """
+        remove all entries whose value satisfies predicate(value); return the number removed
+        """
+        with self._lock:
+            keys = [k for k, (_, v) in self._data.items() if predicate(v)]
+            for k in keys:
+                del self._data[k]
+        return len(keys)
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {'size':      len(self._data),
+                'maxsize':   self.maxsize,
+                'hits':      self.hits,
+                'misses':    self.misses,
+                'evictions': self.evictions}
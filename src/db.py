@@ -1,6 +1,19 @@
 # database engine
 import os
-from sqlmodel import create_engine, SQLModel
+import random
+from contextvars import ContextVar
+from time import perf_counter
+from loguru import logger
+from sqlmodel import create_engine, SQLModel, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from fastapi import Request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+from cache import TTLCache
 
 
 
@@ -8,13 +21,217 @@ from sqlmodel import create_engine, SQLModel
 db_host = os.environ['JIGGY_POSTGRES_HOST']
 user    = os.environ['JIGGY_POSTGRES_USER']
 passwd  = os.environ['JIGGY_POSTGRES_PASS']
+db_port = int(os.environ.get('JIGGY_POSTGRES_PORT', 5432))
 
-DBURI = 'postgresql+psycopg2://%s:%s@%s:5432/jiggyuser' % (user, passwd, db_host)
+# optional comma separated read replica hosts (streaming replicas of JIGGY_POSTGRES_HOST)
+replica_hosts = [h.strip() for h in os.environ.get('JIGGY_POSTGRES_REPLICA_HOSTS', '').split(',') if h.strip()]
+# seconds a user's reads stay on the primary after they (or their memberships) were modified
+REPLICA_PIN_SECONDS = int(os.environ.get('JIGGY_REPLICA_PIN_SECONDS', 10))
 
-engine = create_engine(DBURI, pool_pre_ping=True, echo=False)
+# Pool Config.  Each worker process opens up to POOL_SIZE + MAX_OVERFLOW connections for the endpoints
+# plus up to 4 for background work (and 1 listener with JIGGY_INVALIDATION_BUS=postgres).
+POOL_SIZE         = int(os.environ.get('JIGGY_POSTGRES_POOL_SIZE', 5))
+MAX_OVERFLOW      = int(os.environ.get('JIGGY_POSTGRES_MAX_OVERFLOW', 10))
+POOL_TIMEOUT      = int(os.environ.get('JIGGY_POSTGRES_POOL_TIMEOUT', 30))       # seconds to wait for a connection
+POOL_RECYCLE      = int(os.environ.get('JIGGY_POSTGRES_POOL_RECYCLE', 1800))     # seconds before a connection is replaced
+PRE_PING          = os.environ.get('JIGGY_POSTGRES_PRE_PING', 'true').lower() == 'true'
+STATEMENT_TIMEOUT = int(os.environ.get('JIGGY_POSTGRES_STATEMENT_TIMEOUT', 0))   # milliseconds, 0 for none
+# PgBouncer transaction pooling does not support prepared statements or session level settings
+PGBOUNCER         = os.environ.get('JIGGY_POSTGRES_PGBOUNCER', 'false').lower() == 'true'
 
+DBURI = 'postgresql+psycopg2://%s:%s@%s:%d/jiggyuser' % (user, passwd, db_host, db_port)
+ASYNC_DBURI = 'postgresql+asyncpg://%s:%s@%s:%d/jiggyuser'
 
-if __name__ == "__main__":
-    from models import *
-    SQLModel.metadata.create_all(engine)
+connect_args = {}
+async_connect_args = {}
+if PGBOUNCER:
+    ASYNC_DBURI += '?prepared_statement_cache_size=0'
+    async_connect_args['statement_cache_size'] = 0
+    if STATEMENT_TIMEOUT:
+        logger.warning("JIGGY_POSTGRES_STATEMENT_TIMEOUT is ignored with JIGGY_POSTGRES_PGBOUNCER; configure statement_timeout for the database role")
+elif STATEMENT_TIMEOUT:
+    connect_args['options'] = '-c statement_timeout=%d' % STATEMENT_TIMEOUT
+    async_connect_args['server_settings'] = {'statement_timeout': str(STATEMENT_TIMEOUT)}
+
+
+class PoolWaitStats:
+    """
+    Pool mixin that measures how long checkouts wait for a connection
+    """
+    waits = 0
+    wait_seconds = 0.0
+    max_wait_seconds = 0.0
+
+    def _do_get(self):
+        t0 = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            wait = perf_counter() - t0
+            self.waits += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def stats(self):
+        return {'size':             self.size(),
+                'checked_in':       self.checkedin(),
+                'checked_out':      self.checkedout(),
+                'overflow':         max(0, self.overflow()),
+                'waits':            self.waits,
+                'mean_wait_ms':     1000 * self.wait_seconds / self.waits if self.waits else 0,
+                'max_wait_ms':      1000 * self.max_wait_seconds}
+
+
+class StatsQueuePool(PoolWaitStats, QueuePool):
+    pass
+
+
+class StatsAsyncQueuePool(PoolWaitStats, AsyncAdaptedQueuePool):
+    pass
+
+
+# the sync engine serves background threads (cache invalidation, write-behind) and schema management
+engine = create_engine(DBURI,
+                       poolclass     = StatsQueuePool,
+                       pool_size     = 2,
+                       max_overflow  = 2,
+                       pool_timeout  = POOL_TIMEOUT,
+                       pool_recycle  = POOL_RECYCLE,
+                       pool_pre_ping = PRE_PING,
+                       connect_args  = connect_args,
+                       echo=False)
+
+def _async_engine(host):
+    return create_async_engine(ASYNC_DBURI % (user, passwd, host, db_port),
+                               poolclass     = StatsAsyncQueuePool,
+                               pool_size     = POOL_SIZE,
+                               max_overflow  = MAX_OVERFLOW,
+                               pool_timeout  = POOL_TIMEOUT,
+                               pool_recycle  = POOL_RECYCLE,
+                               pool_pre_ping = PRE_PING,
+                               connect_args  = async_connect_args,
+                               echo=False)
+
+
+# the async engine serves the API endpoints
+async_engine = _async_engine(db_host)
+
+# read only requests are served by the replicas, if any
+replica_engines = [_async_engine(host) for host in replica_hosts]
+
+# users whose reads must go to the primary until their recent writes have replicated
+pinned_users = TTLCache(maxsize=100000, ttl=REPLICA_PIN_SECONDS)   # user_id -> True
+
+# called with the user id after a request session commits writes
+write_listeners = []
+
+
+def pin_user(user_id):
+    """
+    route the reads of the specified user to the primary for REPLICA_PIN_SECONDS
+    """
+    if replica_engines:
+        pinned_users.set(user_id, True)
+
+
+class RoutingSession(Session):
+    """
+    Session that sends the queries of read only requests to a replica unless the
+    request's user (session.info['user_id'], set once authenticated) is pinned to the
+    primary.  Everything else uses the primary.  A session uses a single replica so that
+    its reads share one connection and snapshot.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if self.info.get('read_only') and not self._flushing and replica_engines:
+            user_id = self.info.get('user_id')
+            if user_id is None or pinned_users.get(user_id) is None:
+                if 'replica' not in self.info:
+                    self.info['replica'] = random.choice(replica_engines).sync_engine
+                return self.info['replica']
+        # a session pinned after it began reading from a replica continues on a primary connection
+        return async_engine.sync_engine
 
+
+class RoutingAsyncSession(AsyncSession):
+    """
+    AsyncSession proxying a RoutingSession (sqlmodel's AsyncSession always constructs a plain Session)
+    """
+
+    def __init__(self, bind=None, **kw):
+        kw['future'] = True
+        self.bind = bind
+        self.sync_session = self._proxied = self._assign_proxied(RoutingSession(bind=bind.sync_engine, **kw))
+
+
+# objects remain usable after commit without an implicit (and in async, impossible) lazy reload
+AsyncSessionLocal = sessionmaker(async_engine, class_=RoutingAsyncSession, expire_on_commit=False)
+
+
+def pool_stats():
+    """
+    return gauges for the connection pools of this worker
+    """
+    stats = {'async_pool': async_engine.sync_engine.pool.stats(),
+             'sync_pool':  engine.pool.stats()}
+    for host, replica in zip(replica_hosts, replica_engines):
+        stats[f'replica_pool_{host}'] = replica.sync_engine.pool.stats()
+    return stats
+
+
+# per request database statistics, set by the request middleware
+request_db_stats = ContextVar('request_db_stats', default=None)
+
+
+async def get_session(request: Request):
+    """
+    FastAPI dependency providing the single session (unit of work) shared by the auth helpers
+    and the endpoint of a request.  The session is closed when the request completes.
+    GET requests are read only and may be served by a replica.
+    """
+    async with AsyncSessionLocal() as session:
+        session.info['stats'] = request_db_stats.get()
+        session.info['read_only'] = request.method in ('GET', 'HEAD')
+        yield session
+
+
+@event.listens_for(Session, 'after_begin')
+def count_checkout(session, transaction, connection):
+    # each transaction begun by a session checks a connection out of the pool
+    stats = session.info.get('stats')
+    if stats is not None:
+        stats['checkouts'] += 1
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    # runs in the request's context for the request sessions; background threads have no stats
+    stats = request_db_stats.get()
+    if stats is not None:
+        stats['queries'] += 1
+
+
+@event.listens_for(Session, 'after_flush')
+def note_write(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def note_statement_write(orm_execute_state):
+    # bulk insert, update and delete statements are executed without a flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info['wrote'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def notify_write(session):
+    # read your writes: the committing user's subsequent reads go to the primary
+    user_id = session.info.get('user_id')
+    if session.info.pop('wrote', False) and user_id is not None:
+        for listener in write_listeners:
+            listener(user_id)
+
+
+if __name__ == "__main__":
+    from migrations import migrate
+    migrate(engine)
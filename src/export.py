@@ -0,0 +1,27 @@
+# Streaming NDJSON exports
+# Copyright (C) 2022 William S. Kish
+#
+# Export endpoints stream every row of a query as newline delimited JSON.  Rows are
+# fetched through a server side cursor EXPORT_BATCH at a time and written as they
+# arrive, so memory stays flat and the first line is sent without waiting for the
+# last row.
+
+import os
+
+from fastapi.responses import StreamingResponse
+
+
+EXPORT_BATCH = int(os.environ.get('JIGGY_EXPORT_BATCH', 1000))
+
+
+def ndjson_response(session, statement, serialize):
+    """
+    return a StreamingResponse of serialize(row).json() for each row of the statement.
+    The session must remain open until the response is sent, as the request session does.
+    """
+    async def lines():
+        result = await session.stream(statement.execution_options(yield_per=EXPORT_BATCH))
+        async for partition in result.partitions():
+            yield "".join(serialize(row).json() + "\n" for row in partition)
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
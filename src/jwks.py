@@ -0,0 +1,113 @@
+# Local JWKS cache for an external token issuer (auth0)
+# Copyright (C) 2022 William S. Kish
+#
+# Signing keys are kept parsed in memory, refreshed by a background thread and
+# served stale while the issuer is unreachable, so that verifying a token never
+# waits on the network unless it carries a kid we have not seen.
+
+import json
+import threading
+import urllib.request
+from time import time, sleep
+
+import jwt
+from loguru import logger
+
+
+class JWKSManager:
+    """
+    Maintain the signing keys published at a JWKS uri.
+    The key set may be seeded from a JSON string or a file so that tokens can be verified before
+    (or without) a successful fetch.  If seed_file is specified each fetched key set is also saved
+    there to seed the next start.
+    """
+
+    def __init__(self, uri, seed=None, seed_file=None, refresh_interval=3600, min_refetch_interval=30, timeout=5):
+        self.uri = uri
+        self.seed_file = seed_file
+        self.refresh_interval = refresh_interval          # seconds between background refreshes
+        self.min_refetch_interval = min_refetch_interval  # min seconds between fetches triggered by unknown kids
+        self.timeout = timeout
+        self.keys = {}              # kid -> PyJWK
+        self.fetched_at = 0         # time of the last successful fetch
+        self.fetch_attempted_at = 0
+        self.fetch_lock = threading.Lock()
+        self.fetches = 0
+        self.fetch_errors = 0
+        if seed is None and seed_file:
+            try:
+                with open(seed_file) as f:
+                    seed = f.read()
+            except OSError as e:
+                logger.info(f"no JWKS seed loaded from {seed_file}: {e}")
+        if seed:
+            self._load(json.loads(seed))
+            logger.info(f"seeded {len(self.keys)} JWKS keys for {uri}")
+
+    def _load(self, data):
+        keys = {}
+        for key in jwt.PyJWKSet.from_dict(data).keys:
+            if key.public_key_use in ["sig", None] and key.key_id:
+                keys[key.key_id] = key
+        if not keys:
+            raise jwt.exceptions.PyJWKClientError("The JWKS endpoint did not contain any signing keys")
+        self.keys = keys
+
+    def refresh(self, min_interval=0):
+        """
+        fetch the key set unless a fetch was attempted within min_interval seconds.
+        concurrent callers wait for a fetch in progress rather than starting another.
+        return True if a fetch succeeded.  On failure the previous keys remain in use.
+        """
+        with self.fetch_lock:
+            if time() - self.fetch_attempted_at < min_interval:
+                return False
+            self.fetch_attempted_at = time()
+            self.fetches += 1
+            try:
+                with urllib.request.urlopen(self.uri, timeout=self.timeout) as response:
+                    data = json.load(response)
+                self._load(data)
+                self.fetched_at = time()
+            except Exception as e:
+                self.fetch_errors += 1
+                logger.warning(f"unable to fetch JWKS from {self.uri}: {e}")
+                return False
+        if self.seed_file:
+            try:
+                with open(self.seed_file, 'w') as f:
+                    json.dump(data, f)
+            except OSError as e:
+                logger.warning(f"unable to save JWKS seed to {self.seed_file}: {e}")
+        return True
+
+    def start(self):
+        """
+        start the background thread that fetches the key set now and every refresh_interval thereafter
+        """
+        thread = threading.Thread(target=self._refresh_loop, name='jwks-refresh', daemon=True)
+        thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            # retry failed fetches sooner than the regular refresh
+            fetched = self.refresh()
+            sleep(self.refresh_interval if fetched else self.min_refetch_interval)
+
+    def get_signing_key(self, kid):
+        """
+        return the PyJWK for the specified kid.  An unknown kid triggers a rate limited refetch.
+        """
+        key = self.keys.get(kid)
+        if key is None:
+            self.refresh(min_interval=self.min_refetch_interval)
+            key = self.keys.get(kid)
+        if key is None:
+            raise jwt.exceptions.PyJWKClientError(f'Unable to find a signing key that matches: "{kid}"')
+        return key
+
+    def stats(self):
+        return {'keys':         len(self.keys),
+                'age':          time() - self.fetched_at if self.fetched_at else None,
+                'fetches':      self.fetches,
+                'fetch_errors': self.fetch_errors}
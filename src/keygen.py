@@ -0,0 +1,86 @@
+# Jiggy API key format
+# Copyright (C) 2022 William S. Kish
+#
+# API keys have the form  jgy2-<key id>-<secret>-<tag>  where tag is a truncated
+# HMAC of the key id and secret.  Keys are verified and located by primary key
+# without a database query for malformed or forged keys, and only a hash of the
+# key is stored.  Legacy "jgy-" keys are stored in plaintext and looked up by value.
+
+import os
+import hmac
+import secrets
+from hashlib import sha256
+from string import ascii_letters
+
+from models import ApiKey
+
+
+APIKEY_HMAC_SECRET = os.environ['JIGGY_APIKEY_HMAC_SECRET'].encode()
+
+KEY_PREFIX    = "jgy2"
+LEGACY_PREFIX = "jgy-"
+SECRET_LENGTH = 32
+TAG_LENGTH    = 12
+HASH_PREFIX   = "sha256:"
+
+
+def _tag(key_id, secret):
+    return hmac.new(APIKEY_HMAC_SECRET, f"{key_id}.{secret}".encode(), sha256).hexdigest()[:TAG_LENGTH]
+
+
+def new_secret():
+    return "".join(secrets.choice(ascii_letters) for _ in range(SECRET_LENGTH))
+
+
+def format_apikey(key_id, secret):
+    """
+    return the API key for the specified key id and secret
+    """
+    return f"{KEY_PREFIX}-{key_id}-{secret}-{_tag(key_id, secret)}"
+
+
+def parse_apikey(key):
+    """
+    return the key id of a well formed API key with a valid tag, otherwise None
+    """
+    parts = key.split("-")
+    if len(parts) != 4 or parts[0] != KEY_PREFIX:
+        return None
+    _, key_id, secret, tag = parts
+    if not (key_id.isascii() and key_id.isdigit()) or len(secret) != SECRET_LENGTH:
+        return None
+    if not tag.isascii():
+        # compare_digest only accepts ASCII strings
+        return None
+    if not hmac.compare_digest(tag, _tag(key_id, secret)):
+        return None
+    return int(key_id)
+
+
+def hash_apikey(key):
+    """
+    return the value stored in ApiKey.key for the specified API key
+    """
+    return HASH_PREFIX + sha256(key.encode()).hexdigest()
+
+
+def masked_apikey(apikey):
+    """
+    return the displayable form of a stored ApiKey's key; the secret of hashed keys is not recoverable
+    """
+    if apikey.key.startswith(HASH_PREFIX):
+        return f"{KEY_PREFIX}-{apikey.id}-{'*' * SECRET_LENGTH}"
+    return apikey.key
+
+
+async def add_apikey(session, user_id, description=None):
+    """
+    add a new API key for the specified user to the session.
+    return the ApiKey (which stores only the hash of the key) and the API key itself.
+    """
+    apikey = ApiKey(key='', user_id=user_id, description=description)
+    session.add(apikey)
+    await session.flush()    # assigns apikey.id
+    key = format_apikey(apikey.id, new_secret())
+    apikey.key = hash_apikey(key)
+    return apikey, key
@@ -0,0 +1,83 @@
+# Jiggy JWT signing keys
+# Copyright (C) 2022 William S. Kish
+#
+# Keys are parsed once at startup.  Each key is identified by a 'kid' derived
+# from its public key so that tokens signed by a previous key remain verifiable
+# while keys are rotated.  The signing algorithm follows the type of the
+# configured private key: RSA (RS256), EC P-256 (ES256) or Ed25519 (EdDSA).
+
+import os
+import re
+import json
+from hashlib import sha256
+
+import jwt
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec, ed25519
+
+
+PEM_PUBLIC_KEY_RE = re.compile(r'-----BEGIN PUBLIC KEY-----.+?-----END PUBLIC KEY-----', re.S)
+
+
+def key_id(public_key):
+    """
+    return the kid for the specified public key object
+    """
+    der = public_key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+    return sha256(der).hexdigest()[:16]
+
+
+def key_algorithm(key):
+    """
+    return the JWT algorithm used with the specified private or public key object
+    """
+    if isinstance(key, (rsa.RSAPrivateKey, rsa.RSAPublicKey)):
+        return 'RS256'
+    if isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)) and isinstance(key.curve, ec.SECP256R1):
+        return 'ES256'
+    if isinstance(key, (ed25519.Ed25519PrivateKey, ed25519.Ed25519PublicKey)):
+        return 'EdDSA'
+    raise ValueError(f"Unsupported JWT key type {type(key).__name__}")
+
+
+def load_public_keys(pem):
+    """
+    load all of the PEM encoded public keys in the supplied string
+    """
+    return [serialization.load_pem_public_key(m.group().encode()) for m in PEM_PUBLIC_KEY_RE.finditer(pem)]
+
+
+# the key used to sign the tokens we issue; JIGGY_JWT_RSA_PRIVATE_KEY is accepted for existing deployments
+SIGNING_KEY = serialization.load_pem_private_key(os.environ.get('JIGGY_JWT_PRIVATE_KEY',
+                                                                os.environ.get('JIGGY_JWT_RSA_PRIVATE_KEY', '')).encode(),
+                                                 password=None)
+SIGNING_ALGORITHM = os.environ.get('JIGGY_JWT_ALGORITHM', key_algorithm(SIGNING_KEY))
+if SIGNING_ALGORITHM != key_algorithm(SIGNING_KEY):
+    raise ValueError(f"JIGGY_JWT_ALGORITHM {SIGNING_ALGORITHM} does not match the {key_algorithm(SIGNING_KEY)} signing key")
+
+ACTIVE_PUBLIC_KEY = SIGNING_KEY.public_key()
+ACTIVE_KID = key_id(ACTIVE_PUBLIC_KEY)
+
+# previously active keys whose tokens are still accepted during a key rotation
+PREVIOUS_PUBLIC_KEYS = load_public_keys(os.environ.get('JIGGY_JWT_PREVIOUS_PUBLIC_KEYS', ''))
+
+# kid -> public key object for all keys accepted for verification
+verification_keys = {key_id(k): k for k in PREVIOUS_PUBLIC_KEYS}
+verification_keys[ACTIVE_KID] = ACTIVE_PUBLIC_KEY
+
+
+def jwk(public_key):
+    """
+    return the JWK dict for the specified public key object
+    """
+    algorithm = key_algorithm(public_key)
+    key = json.loads(jwt.algorithms.get_default_algorithms()[algorithm].to_jwk(public_key))
+    key.pop('key_ops', None)
+    key.update({'kid': key_id(public_key), 'alg': algorithm, 'use': 'sig'})
+    return key
+
+
+# the JWKS document published for consumers of our tokens, and its strong ETag
+JWKS_JSON = json.dumps({'keys': [jwk(k) for k in verification_keys.values()]}, sort_keys=True).encode()
+JWKS_ETAG = '"%s"' % sha256(JWKS_JSON).hexdigest()[:32]
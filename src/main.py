@@ -3,7 +3,7 @@
 #
 
 from __future__ import annotations
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
 import os
 
 from loguru import logger
@@ -21,9 +21,78 @@ app = FastAPI( title='jiggyuser-api',
 
 app.mount(f"/{API_PATH}", app)
 
+
+from starlette.datastructures import MutableHeaders
+from db import request_db_stats
+
+class DBStatsMiddleware:
+    """
+    report the number of database connection checkouts made by the request in X-DB-Checkouts
+    and the number of statements it executed in X-DB-Queries.
+    A plain ASGI middleware so that endpoints can read a streamed request body while streaming
+    their response (@app.middleware consumes the request's receive channel while streaming).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or request_db_stats.get() is not None:
+            # the request already passed through this middleware on its way to the mounted app
+            return await self.app(scope, receive, send)
+        stats = {'checkouts': 0, 'queries': 0}
+        request_db_stats.set(stats)
+
+        async def send_with_stats(message):
+            if message['type'] == 'http.response.start':
+                headers = MutableHeaders(scope=message)
+                headers['X-DB-Checkouts'] = str(stats['checkouts'])
+                headers['X-DB-Queries'] = str(stats['queries'])
+            await send(message)
+
+        await self.app(scope, receive, send_with_stats)
+
+app.add_middleware(DBStatsMiddleware)
+
+
+import keys
+
+# how long consumers may cache our signing keys before revalidating
+JWKS_MAX_AGE = int(os.environ.get("JIGGY_JWKS_MAX_AGE", 300))
+
+@app.get('/.well-known/jwks.json', include_in_schema=False)
+def get_jwks(request: Request) -> Response:
+    """
+    return the public keys used to verify Jiggy-issued JWTs
+    """
+    headers = {'ETag': keys.JWKS_ETAG,
+               'Cache-Control': f'public, max-age={JWKS_MAX_AGE}'}
+    if_none_match = request.headers.get('if-none-match', '')
+    if keys.JWKS_ETAG in [etag.strip() for etag in if_none_match.split(',')] or if_none_match.strip() == '*':
+        return Response(status_code=304, headers=headers)
+    return Response(content=keys.JWKS_JSON, media_type='application/json', headers=headers)
+
 # import endpoints
 import user
 import apikey
 import team
+import provision
+import auth
+import db
+
+
+if os.environ.get("JIGGY_STATS_ENDPOINT"):
+    import resource
+
+    @app.get('/stats', include_in_schema=False)
+    def get_stats():
+        """
+        return internal cache, connection pool and write-behind statistics
+        """
+        return {**auth.cache_stats(),
+                **db.pool_stats(),
+                'apikey_last_used': apikey.last_used_buffer.stats(),
+                'username_cache':   user.usernames.stats(),
+                'max_rss_kb':       resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
 
 logger.info(f"{API_HOST}/{API_PATH}")
@@ -0,0 +1,130 @@
+# Versioned schema migrations
+# Copyright (C) 2022 William S. Kish
+#
+# The applied schema version is recorded in the schema_version table.  A new database
+# is created from the models and stamped with the latest version; an existing database
+# has each migration newer than its version applied in order, each in its own transaction.
+# New schema changes are made to the models and appended here as a new version.
+#
+# run with:  python db.py
+
+from loguru import logger
+from sqlalchemy import inspect, text
+from sqlmodel import SQLModel
+
+import models
+
+
+def rename_duplicates(table, column):
+    """
+    return a migration step that renames all but the oldest row of each group of rows sharing a
+    name to <name>-<id> (truncated to the 39 character name limit), logging each rename
+    """
+    def step(conn):
+        renamed = conn.execute(text(
+            f'UPDATE {table} AS a SET {column} = left(a.{column}, 38 - length(a.id::text)) || \'-\' || a.id '
+            f'FROM {table} AS b WHERE a.{column} = b.{column} AND a.id > b.id '
+            f'RETURNING a.id, a.{column}')).all()
+        for row_id, name in renamed:
+            logger.warning(f"renamed duplicate {table}.{column} of id {row_id} to {name}")
+    return step
+
+
+def check_duplicate_auth0_userids(conn):
+    """
+    fail the migration if several users share an auth0 user id, since that can't be resolved automatically
+    """
+    duplicates = conn.execute(text('SELECT auth0_userid, array_agg(id ORDER BY id) FROM "user" '
+                                   'WHERE auth0_userid IS NOT NULL GROUP BY auth0_userid HAVING count(*) > 1')).all()
+    if duplicates:
+        for auth0_userid, user_ids in duplicates:
+            logger.error(f"auth0 user id {auth0_userid} is shared by users {user_ids}")
+        raise RuntimeError(f"{len(duplicates)} auth0 user ids are shared by several users; "
+                           "delete or clear the auth0_userid of the extra users and migrate again")
+
+
+# (version, description, [statements or functions of the connection])
+MIGRATIONS = [
+    (1, "unique usernames, auth0 user ids and team names", [
+        # duplicates were possible before the unique indexes
+        check_duplicate_auth0_userids,
+        rename_duplicates('"user"', 'username'),
+        rename_duplicates('team', 'name'),
+        'DROP INDEX IF EXISTS ix_user_username',
+        'CREATE UNIQUE INDEX ix_user_username ON "user" (username)',
+        'DROP INDEX IF EXISTS ix_user_auth0_userid',
+        'CREATE UNIQUE INDEX ix_user_auth0_userid ON "user" (auth0_userid)',
+        'DROP INDEX IF EXISTS ix_team_name',
+        'CREATE UNIQUE INDEX ix_team_name ON team (name)',
+    ]),
+    (2, "composite team membership indexes", [
+        # a user can only be a member of a team once; keep the oldest of any duplicate memberships
+        'DELETE FROM teammember a USING teammember b '
+        'WHERE a.user_id = b.user_id AND a.team_id = b.team_id AND a.id > b.id',
+        'CREATE UNIQUE INDEX ix_teammember_user_id_team_id ON teammember (user_id, team_id)',
+        'CREATE INDEX ix_teammember_team_id_role ON teammember (team_id, role)',
+        # superseded by the leading columns of the composite indexes
+        'DROP INDEX IF EXISTS ix_teammember_user_id',
+        'DROP INDEX IF EXISTS ix_teammember_team_id',
+    ]),
+    (3, "user created_at and updated_at", [
+        'ALTER TABLE "user" ADD COLUMN created_at NUMERIC(14, 3)',
+        'ALTER TABLE "user" ADD COLUMN updated_at NUMERIC(14, 3)',
+        'UPDATE "user" SET created_at = round(extract(epoch from now())::numeric, 3), updated_at = created_at',
+        'ALTER TABLE "user" ALTER COLUMN created_at SET NOT NULL',
+        'ALTER TABLE "user" ALTER COLUMN updated_at SET NOT NULL',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# serializes concurrent migration runs
+LOCK_ID = 0x6a696767
+
+
+def schema_version(conn):
+    """
+    return the schema version of the database or None if it has no schema_version table
+    """
+    if not inspect(conn).has_table('schema_version'):
+        return None
+    return conn.execute(text('SELECT version FROM schema_version')).scalar()
+
+
+def migrate(engine):
+    """
+    bring the database schema up to LATEST_VERSION
+    """
+    with engine.connect() as conn:
+        conn.execute(text('SELECT pg_advisory_lock(:id)'), {'id': LOCK_ID})
+        conn.commit()
+        try:
+            with conn.begin():
+                version = schema_version(conn)
+                if version is None:
+                    conn.execute(text('CREATE TABLE schema_version (version INTEGER NOT NULL)'))
+                    if inspect(conn).has_table('user'):
+                        # created by create_all before migrations existed
+                        version = 0
+                    else:
+                        SQLModel.metadata.create_all(conn)
+                        version = LATEST_VERSION
+                        logger.info(f"created schema version {version}")
+                    conn.execute(text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': version})
+            for migration_version, description, statements in MIGRATIONS:
+                if migration_version <= version:
+                    continue
+                logger.info(f"migrating to schema version {migration_version}: {description}")
+                with conn.begin():
+                    for statement in statements:
+                        if callable(statement):
+                            statement(conn)
+                        else:
+                            conn.execute(text(statement))
+                    conn.execute(text('UPDATE schema_version SET version = :version'), {'version': migration_version})
+                version = migration_version
+            logger.info(f"schema version {version}")
+        finally:
+            conn.rollback()
+            conn.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': LOCK_ID})
+            conn.commit()
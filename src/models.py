@@ -1,6 +1,7 @@
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 from sqlmodel import Field, SQLModel, Column, ARRAY, Float, Enum
+from sqlalchemy import Index
 from pydantic import BaseModel, ValidationError, validator
 from array import array
 from pydantic import condecimal
@@ -12,18 +13,25 @@ import re
 timestamp = condecimal(max_digits=14, decimal_places=3)
 
 
+def timestamp_now():
+    """
+    return the current epoch time at the precision of a timestamp, so that new objects
+    validate without first being reloaded from the database
+    """
+    return round(time(), 3)
+
+
 ###
 ## User
 ###
 
 class User(SQLModel, table=True):
     id:              int           = Field(primary_key=True, description="Internal user_id")
-    username:        str           = Field(index=True, min_length=3, max_length=39, description='Unique name for the user.')
-    auth0_userid :   Optional[str] = Field(default=None, index=True, description='Auth0 userid.')
+    username:        str           = Field(index=True, unique=True, min_length=3, max_length=39, description='Unique name for the user.')
+    auth0_userid :   Optional[str] = Field(default=None, index=True, unique=True, description='Auth0 userid.')
     default_team_id: int           = Field(description="The default team for this user")
-    # todo add to db
-    #created_at:  timestamp     = Field(default_factory=time, description='The epoch timestamp when the team was created.')
-    #updated_at:  timestamp     = Field(default_factory=time, description='The epoch timestamp when the team was updated.')
+    created_at:      timestamp     = Field(default_factory=timestamp_now, description='The epoch timestamp when the user was created.')
+    updated_at:      timestamp     = Field(default_factory=timestamp_now, description='The epoch timestamp when the user was updated.')
 
 
 class UserPostRequest(BaseModel):
@@ -34,6 +42,21 @@ class UserPatchRequest(BaseModel):
     username:        Optional[str] = Field(min_length=3, max_length=39, description='Unique name for the user.')
     default_team_id: Optional[int] = Field(description="The default team for this user")
 
+
+class UserResolveRequest(BaseModel):
+    user_ids:  List[int] = Field(default=[], max_items=5000, description="User ids to resolve")
+    usernames: List[str] = Field(default=[], max_items=5000, description="Usernames to resolve")
+
+
+class UserSummary(BaseModel):
+    id:       int = Field(description="Internal user_id")
+    username: str = Field(description='Unique name for the user.')
+
+
+class UserResolveResponse(BaseModel):
+    items: List[UserSummary] = Field(description="The requested users that share a team with the caller; "
+                                     "unknown users and users without a shared team are omitted.")
+
     
 ###
 ## Team
@@ -41,10 +64,10 @@ class UserPatchRequest(BaseModel):
 
 class Team(SQLModel, table=True):
     id:          int           = Field(primary_key=True, description="Internal team id")
-    name:        str           = Field(index=True, min_length=3, max_length=39, description='Unique name for this team.')
+    name:        str           = Field(index=True, unique=True, min_length=3, max_length=39, description='Unique name for this team.')
     description: Optional[str] = Field(default=None, description='Optional user supplied description.')
-    created_at:  timestamp     = Field(default_factory=time, description='The epoch timestamp when the team was created.')
-    updated_at:  timestamp     = Field(default_factory=time, description='The epoch timestamp when the team was updated.')
+    created_at:  timestamp     = Field(default_factory=timestamp_now, description='The epoch timestamp when the team was created.')
+    updated_at:  timestamp     = Field(default_factory=timestamp_now, description='The epoch timestamp when the team was updated.')
 
 
 class TeamPostRequest(BaseModel):
@@ -64,11 +87,14 @@ class TeamRole(str, enum.Enum):
 
 
 class TeamMember(SQLModel, table=True):
+    # membership lookups by user and team, and admin counts by team and role
+    __table_args__ = (Index('ix_teammember_user_id_team_id', 'user_id', 'team_id', unique=True),
+                      Index('ix_teammember_team_id_role', 'team_id', 'role'))
     id:         int       = Field(primary_key=True, description="Internal membership id")
-    team_id:    int       = Field(index=True, description="The team_id that the associated user is a member of.")
-    user_id:    int       = Field(index=True, description="The user_id that is  a member of the associated team.")
-    created_at: timestamp = Field(default_factory=time, description='The epoch timestamp when the membership was created.')
-    updated_at: timestamp = Field(default_factory=time, description='The epoch timestamp when the membership was updated.')
+    team_id:    int       = Field(description="The team_id that the associated user is a member of.")
+    user_id:    int       = Field(description="The user_id that is  a member of the associated team.")
+    created_at: timestamp = Field(default_factory=timestamp_now, description='The epoch timestamp when the membership was created.')
+    updated_at: timestamp = Field(default_factory=timestamp_now, description='The epoch timestamp when the membership was updated.')
     invited_by: int       = Field(index=True, description="The user that invited this member to the team.")
     role:       TeamRole  = Field(sa_column=Column(Enum(TeamRole)), description="The user's role in the team")
     accepted:   bool      = Field(default=False, description='True if the user has accepted the team membership.')
@@ -79,27 +105,57 @@ class TeamMemberPostRequest(BaseModel):
     role:     TeamRole = Field(description="The user's role in the team")
 
 
+class TeamMemberOp(str, enum.Enum):
+    add    = 'add'
+    update = 'update'
+    remove = 'remove'
+
+
+class TeamMemberOperation(BaseModel):
+    op:       TeamMemberOp       = Field(description="add the user to the team, update their role, or remove them")
+    username: str                = Field(description="The user_name of the member.")
+    role:     Optional[TeamRole] = Field(default=None, description="The user's role in the team (add and update)")
+
+
+class TeamMembersBatchRequest(BaseModel):
+    items: List[TeamMemberOperation] = Field(max_items=1000, description="Membership changes, applied in one transaction")
+
+
 class TeamMemberPatchRequest(BaseModel):
-    role:       TeamRole  = Field(sa_column=Column(Enum(TeamRole)), description="The user's role in the team")
-    accepted:   bool      = Field(default=False, description='True if the user has accepted the team membership.')
+    role:       Optional[TeamRole] = Field(default=None, description="The user's role in the team (admin only)")
+    accepted:   Optional[bool]     = Field(default=None, description='True if the user has accepted the team membership.')
 
     
 class UserTeams(BaseModel):
     items: List[Team] = Field(description="The list of all of the user's teams")
+    next_cursor: Optional[str] = Field(default=None, description="Cursor for the next page; None on the last page.")
 
     
 class TeamMemberResponse(BaseModel):
-    id:                  int       = Field(description="Internal membership id")
-    username:            str       = Field(description="Member username")
-    created_at:          timestamp = Field(description='The epoch timestamp when the membership was created.')
-    updated_at:          timestamp = Field(description='The epoch timestamp when the membership was updated.')
-    invited_by_username: str       = Field(description="The username that invited this member to the team.")
-    role:                TeamRole  = Field(description="The user's role in the team")
-    accepted:            bool      = Field(description='True if the user has accepted the team membership.')
+    id:                  int           = Field(description="Internal membership id")
+    username:            str           = Field(description="Member username")
+    created_at:          timestamp     = Field(description='The epoch timestamp when the membership was created.')
+    updated_at:          timestamp     = Field(description='The epoch timestamp when the membership was updated.')
+    invited_by_username: Optional[str] = Field(description="The username that invited this member to the team; null if that user has been deleted.")
+    role:                TeamRole      = Field(description="The user's role in the team")
+    accepted:            bool          = Field(description='True if the user has accepted the team membership.')
     
     
+class TeamMemberOperationResult(BaseModel):
+    op:       TeamMemberOp                 = Field(description="The requested operation")
+    username: str                          = Field(description="The user_name of the member")
+    status:   int                          = Field(description="HTTP status of the operation; 200 if it was applied")
+    detail:   Optional[str]                = Field(default=None, description="Why the operation was rejected")
+    member:   Optional[TeamMemberResponse] = Field(default=None, description="The added or updated membership")
+
+
+class TeamMembersBatchResponse(BaseModel):
+    items: List[TeamMemberOperationResult] = Field(description="The result of each operation, in request order")
+
+
 class GetTeamMembersResponse(BaseModel):
     items: List[TeamMemberResponse] = Field(description="List of Team Members")
+    next_cursor: Optional[str] = Field(default=None, description="Cursor for the next page; None on the last page.")
 
 
 
@@ -113,22 +169,44 @@ class ApiKey(SQLModel, table=True):
     key:         str           = Field(index=True, description='Unique secret api key')
     user_id:     int           = Field(index=True, foreign_key='user.id', description='The user_id that owns this key.')
     description: Optional[str] = Field(default=None, description='Optional user supplied description of the key.')
-    created_at:  timestamp     = Field(default_factory=time, description='The epoch timestamp when the vector was created.')
-    last_used :  timestamp     = Field(default_factory=time, description='The epoch timestamp when the key was last used to create a JWT.')
+    created_at:  timestamp     = Field(default_factory=timestamp_now, description='The epoch timestamp when the vector was created.')
+    last_used :  timestamp     = Field(default_factory=timestamp_now, description='The epoch timestamp when the key was last used to create a JWT.')
 
 class  ApiKeyRequest(BaseModel):
     description: Optional[str] = Field(default=None, description='Optional user supplied description of the key.')
 
 class AllApiKeyResponse(BaseModel):
     items: list[ApiKey] = Field(description="List of all Api Keys")
+    next_cursor: Optional[str] = Field(default=None, description="Cursor for the next page; None on the last page.")
 
 ###
 ##  Auth
 ###
 
 class AuthRequest(BaseModel):
-    key : str = Field(description = "The API key")
+    key :          str  = Field(description = "The API key")
+    include_teams: bool = Field(default=False, description = "Embed the user's team memberships and roles in the JWT. "
+                                "For services consuming the JWT; team changes are not reflected in it until the JWT is renewed.")
     
+class TokenIntrospectRequest(BaseModel):
+    tokens: List[str] = Field(max_items=100, description="Bearer tokens to verify; duplicates are verified once.")
+
+class TokenIntrospection(BaseModel):
+    active:  bool                          = Field(description="True if the token is valid")
+    user_id: Optional[int]                 = Field(default=None, description="The user the token authenticates")
+    teams:   Optional[Dict[int, TeamRole]] = Field(default=None, description="The user's current team memberships and roles")
+    exp:     Optional[int]                 = Field(default=None, description="The epoch timestamp when the token expires")
+    error:   Optional[str]                 = Field(default=None, description="Why the token is not valid")
+
+class TokenIntrospectResponse(BaseModel):
+    items: List[TokenIntrospection] = Field(description="The introspection of each requested token, in request order")
+
+class RefreshRequest(BaseModel):
+    refresh_token: str = Field(description = "A refresh token returned by /auth")
+
 class Jwt(BaseModel):
     jwt: str = Field(description='The JWT to used as bearer token')
+    expires_in:    Optional[int] = Field(default=None, description='Seconds until the JWT expires.')
+    refresh_token: Optional[str] = Field(default=None, description='Token that can be traded for a new JWT at /auth/refresh '
+                                         'until it expires or its API key is deleted.')
 
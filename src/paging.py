@@ -0,0 +1,51 @@
+# Keyset pagination for the list endpoints
+# Copyright (C) 2022 William S. Kish
+#
+# Lists are ordered by primary key.  A page ends with an opaque cursor encoding
+# the last key returned; the next page selects the rows after that key, so every
+# page is an index range scan regardless of how deep the client has paged.
+# Without a limit the whole list is returned as before.
+
+import base64
+import binascii
+
+from fastapi import Query, HTTPException
+
+
+MAX_LIMIT = 1000
+
+LimitQuery  = Query(default=None, ge=1, le=MAX_LIMIT, description="Maximum number of items to return; all items when omitted.")
+CursorQuery = Query(default=None, description="The next_cursor of the previous page.")
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(str(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def paginate(statement, key_column, limit, cursor):
+    """
+    return the statement restricted to the page after cursor, fetching one extra row to detect a following page
+    """
+    statement = statement.order_by(key_column)
+    if cursor is not None:
+        statement = statement.where(key_column > decode_cursor(cursor))
+    if limit is not None:
+        statement = statement.limit(limit + 1)
+    return statement
+
+
+def page(rows, limit, key):
+    """
+    return the rows of the page and the cursor of the next page (None on the last page)
+    """
+    if limit is None or len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(key(rows[-1]))
@@ -0,0 +1,281 @@
+# Bulk user provisioning
+# Copyright (C) 2022 William S. Kish
+#
+# An admin uploads users as NDJSON or CSV.  The request body is read as a stream and
+# parsed IMPORT_CHUNK rows at a time; each chunk is validated with the UserPostRequest
+# rules and created with one multi-row INSERT per table (teams, users, memberships and
+# API keys) in its own transaction, so a failed row never aborts the rest of the import
+# and an interrupted import keeps the chunks already committed.
+#
+# The result of every row (the new user id and API key, or the error) and a progress line
+# are streamed back as NDJSON as soon as each chunk is committed, followed by a summary.
+# The upload is read independently of the response: a client that only reads the response
+# once its upload is finished gets the same results, held in memory until they are sent.
+# API keys are only stored hashed, so the response is the only copy of the new keys.
+
+import csv
+import json
+import os
+import asyncio
+from time import perf_counter
+
+from loguru import logger
+from pydantic import ValidationError
+from fastapi import Request, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import delete
+
+from main import app
+from auth import *
+from db import AsyncSession, get_session
+from models import *
+from keygen import format_apikey, hash_apikey, new_secret
+
+
+ADMIN_USER_IDS = {int(i) for i in os.environ.get('JIGGY_ADMIN_USER_IDS', '').split(',') if i.strip()}
+
+IMPORT_CHUNK = int(os.environ.get('JIGGY_IMPORT_CHUNK', 1000))
+
+
+async def verified_admin_user_id(token: str = Depends(token_auth_scheme),
+                                 session: AsyncSession = Depends(get_session)) -> int:
+    """
+    return the user_id of the authenticated user, who must be listed in JIGGY_ADMIN_USER_IDS
+    """
+    user_id = await verified_user_id(token, session)
+    if user_id not in ADMIN_USER_IDS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user_id
+
+
+async def body_lines(request):
+    """
+    yield the lines of the request body (as bytes) as they are received
+    """
+    buffer = b''
+    async for data in request.stream():
+        buffer += data
+        if b'\n' not in data:
+            continue
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            yield line.rstrip(b'\r')
+    if buffer:
+        yield buffer.rstrip(b'\r')
+
+
+async def body_rows(request, csv_format):
+    """
+    yield (line number, row dict or error) for each non-blank line of an NDJSON or CSV body.
+    CSV bodies start with a header line naming the columns; quoted fields can not contain newlines.
+    """
+    header = None
+    number = 0
+    async for line in body_lines(request):
+        number += 1
+        try:
+            line = line.decode()
+        except UnicodeDecodeError:
+            yield number, "Invalid UTF-8"
+            continue
+        if not line.strip():
+            continue
+        if csv_format:
+            values = next(csv.reader([line]))
+            if header is None:
+                header = [name.strip() for name in values]
+                continue
+            yield number, dict(zip(header, values))
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, "Invalid JSON"
+            continue
+        if not isinstance(row, dict):
+            yield number, "Expected a JSON object"
+            continue
+        yield number, row
+
+
+def validate_row(row):
+    """
+    return (username, auth0_userid) of a row, raising ValueError for an invalid row
+    """
+    try:
+        body = UserPostRequest(username=row.get('username'))
+    except ValidationError as e:
+        raise ValueError("; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()))
+    auth0_userid = row.get('auth0_userid') or None
+    if auth0_userid is not None and not isinstance(auth0_userid, str):
+        raise ValueError("auth0_userid: str type expected")
+    # postgres text can't contain NUL characters
+    if '\x00' in body.username or (auth0_userid and '\x00' in auth0_userid):
+        raise ValueError("NUL characters are not allowed")
+    return body.username, auth0_userid
+
+
+async def import_chunk(session, admin_user_id, rows):
+    """
+    create the users of a chunk of validated (line number, username, auth0_userid) rows in one transaction.
+    return a result dict for each row.
+    """
+    now = timestamp_now()
+    results = {}
+    # the user's own team is named after the user; names taken by existing teams are rejected
+    statement = insert(Team).values([{'name': username, 'created_at': now, 'updated_at': now}
+                                     for _, username, _ in rows])
+    statement = statement.on_conflict_do_nothing(index_elements=['name']).returning(Team.id, Team.name)
+    team_ids = {name: team_id for team_id, name in await session.execute(statement)}
+
+    rows = [row for row in rows if row[1] in team_ids]
+    user_ids = {}
+    if rows:
+        statement = insert(User).values([{'username': username, 'auth0_userid': auth0_userid,
+                                          'default_team_id': team_ids[username], 'created_at': now, 'updated_at': now}
+                                         for _, username, auth0_userid in rows])
+        statement = statement.on_conflict_do_nothing().returning(User.id, User.username)
+        user_ids = {username: user_id for user_id, username in await session.execute(statement)}
+
+    # teams of users rejected for an existing username or auth0 user id
+    orphans = [team_ids[username] for _, username, _ in rows if username not in user_ids]
+    if orphans:
+        await session.execute(delete(Team).where(Team.id.in_(orphans)))
+
+    rows = [row for row in rows if row[1] in user_ids]
+    if rows:
+        await session.execute(insert(TeamMember).values([{'team_id': team_ids[username], 'user_id': user_ids[username],
+                                                          'invited_by': user_ids[username], 'role': TeamRole.admin,
+                                                          'accepted': True, 'created_at': now, 'updated_at': now}
+                                                         for _, username, _ in rows]))
+        # key ids are allocated up front since the key itself is derived from its id
+        key_ids = (await session.execute(text("SELECT nextval('apikey_id_seq') FROM generate_series(1, CAST(:n AS INTEGER))"),
+                                         {'n': len(rows)})).scalars().all()
+        apikeys = [format_apikey(key_id, new_secret()) for key_id in key_ids]
+        await session.execute(insert(ApiKey).values([{'id': key_id, 'key': hash_apikey(key), 'user_id': user_ids[username],
+                                                      'description': "Autogenerated user key",
+                                                      'created_at': now, 'last_used': now}
+                                                     for key_id, key, (_, username, _) in zip(key_ids, apikeys, rows)]))
+        for key, (number, username, _) in zip(apikeys, rows):
+            results[number] = {'line': number, 'user_id': user_ids[username], 'username': username, 'apikey': key}
+    await session.commit()
+    logger.info(f"admin {admin_user_id} imported {len(rows)} users")
+    return results
+
+
+async def import_rows(request, session, admin_user_id, csv_format, emit):
+    """
+    create the users of the request body a chunk at a time, calling emit with the NDJSON lines of the
+    results of each chunk
+    """
+    totals = {'rows': 0, 'created': 0, 'errors': 0}
+    t0 = perf_counter()
+
+    def report(results):
+        created = sum('user_id' in result for result in results.values())
+        totals['rows'] += len(results)
+        totals['created'] += created
+        totals['errors'] += len(results) - created
+        progress = dict(totals, rows_per_second=round(totals['rows'] / (perf_counter() - t0), 1))
+        emit("".join(json.dumps(results[number]) + "\n" for number in sorted(results)) +
+             json.dumps({'progress': progress}) + "\n")
+
+    async def flush(chunk, errors):
+        try:
+            results = await import_chunk(session, admin_user_id, chunk) if chunk else {}
+            failure = "The specified username or auth0 user is not available."
+        except SQLAlchemyError as e:
+            # none of the chunk's users were created; the following chunks are still imported
+            await session.rollback()
+            logger.exception(f"admin {admin_user_id} import chunk failed")
+            results = {}
+            failure = f"Import of the rows {chunk[0][0]}-{chunk[-1][0]} failed: {str(getattr(e, 'orig', e)).splitlines()[0]}"
+        for number, _, _ in chunk:
+            results.setdefault(number, {'line': number, 'error': failure})
+        results.update(errors)
+        report(results)
+
+    chunk = []
+    errors = {}
+    seen_usernames = set()
+    seen_auth0_userids = set()
+    try:
+        async for number, row in body_rows(request, csv_format):
+            try:
+                if isinstance(row, str):
+                    raise ValueError(row)
+                username, auth0_userid = validate_row(row)
+                if username in seen_usernames or (auth0_userid is not None and auth0_userid in seen_auth0_userids):
+                    raise ValueError("Duplicate username or auth0 user in this chunk")
+                seen_usernames.add(username)
+                seen_auth0_userids.add(auth0_userid)
+                chunk.append((number, username, auth0_userid))
+            except ValueError as e:
+                errors[number] = {'line': number, 'error': str(e)}
+            if len(chunk) + len(errors) >= IMPORT_CHUNK:
+                await flush(chunk, errors)
+                chunk, errors = [], {}
+                seen_usernames.clear()
+                seen_auth0_userids.clear()
+        if chunk or errors:
+            await flush(chunk, errors)
+    except Exception as e:
+        # the results of the chunks already committed have been emitted; every other row read gets an error
+        logger.exception(f"admin {admin_user_id} import aborted")
+        try:
+            await session.rollback()
+        except SQLAlchemyError:
+            logger.warning("unable to roll back the aborted import")
+        results = {number: {'line': number, 'error': "Not imported: the import was aborted"} for number, _, _ in chunk}
+        results.update(errors)
+        report(results)
+        totals['aborted'] = f"Import aborted after {totals['rows']} rows: {e.__class__.__name__}"
+    elapsed = perf_counter() - t0
+    emit(json.dumps({'done': dict(totals, seconds=round(elapsed, 3),
+                                  rows_per_second=round(totals['rows'] / elapsed, 1) if elapsed else None)}) + "\n")
+    logger.info(f"admin {admin_user_id} import: {totals} in {elapsed:.1f}s")
+
+
+class ImportResponse(StreamingResponse):
+    """
+    StreamingResponse that doesn't listen for the client disconnecting, since the import endpoint
+    reads the request body from the receive channel while its response is streamed
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+
+@app.post('/users/import', include_in_schema=False)
+async def post_users_import(request: Request,
+                            admin_user_id: int = Depends(verified_admin_user_id),
+                            session: AsyncSession = Depends(get_session)):
+    """
+    Create users from an NDJSON or CSV (Content-Type: text/csv) request body with a username and
+    optional auth0_userid per row.  Each user gets their own team and an API key, as with POST /users.
+    Streams an NDJSON line per row with the new user_id and apikey or the row's error and a progress
+    line as each chunk is committed, then a final summary line.
+    """
+    csv_format = request.headers.get('content-type', '').split(';')[0].strip() == 'text/csv'
+    results = asyncio.Queue()
+
+    async def run():
+        try:
+            await import_rows(request, session, admin_user_id, csv_format, results.put_nowait)
+        finally:
+            results.put_nowait(None)
+
+    task = asyncio.create_task(run())
+
+    async def lines():
+        try:
+            while (data := await results.get()) is not None:
+                yield data
+        finally:
+            if not task.done():
+                task.cancel()
+
+    return ImportResponse(lines(), media_type='application/x-ndjson')
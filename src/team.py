@@ -4,7 +4,10 @@
 
 from __future__ import annotations
 from loguru import logger
-from sqlmodel import Session, select, delete
+from sqlmodel import select, delete, func, insert, update
+from collections import defaultdict
+from sqlalchemy.orm import aliased
+from sqlalchemy.exc import IntegrityError
 from string import ascii_lowercase
 from random import sample
 from fastapi import Path, Query, Depends, HTTPException
@@ -12,236 +15,370 @@ from time import time
 
 from main import app
 from auth import *
-from db import engine
+from db import AsyncSession, get_session
 from models import *
+from paging import LimitQuery, CursorQuery, paginate, page
+from export import ndjson_response
 
 
 
 @app.get('/teams')
-def get_teams(token: str = Depends(token_auth_scheme)) -> UserTeams:
+async def get_teams(token: str = Depends(token_auth_scheme),
+                    limit:  Optional[int] = LimitQuery,
+                    cursor: Optional[str] = CursorQuery,
+                    session: AsyncSession = Depends(get_session)) -> UserTeams:
     """
-    return all of the user's teams
+    return the user's teams, a page at a time if a limit is specified
     """
-    user_id, user_team_ids = verified_user_id_teams(token)
-    with Session(engine) as session:
-        items = session.exec(select(Team).where(Team.id.in_(user_team_ids))).all()
-        return UserTeams(items = items)
+    user_id, user_team_ids = await verified_user_id_teams(token, session)
+    statement = paginate(select(Team).where(Team.id.in_(user_team_ids)), Team.id, limit, cursor)
+    items, next_cursor = page((await session.exec(statement)).all(), limit, lambda t: t.id)
+    return UserTeams(items=items, next_cursor=next_cursor)
     
-              
+          
 @app.post('/teams', response_model=Team)
-def post_team(token: str = Depends(token_auth_scheme),
-              body: TeamPostRequest = ...) -> Team:
+async def post_team(token: str = Depends(token_auth_scheme),
+                    body: TeamPostRequest = ...,
+                    session: AsyncSession = Depends(get_session)) -> Team:
     """
     Create a Team with the specified name.  Names must currently be unique.
     """
     logger.info(body)    
-    user_id, user_team_ids = verified_user_id_teams(token)
-    with Session(engine) as session:    
-        statement = select(Team).where(Team.name == body.name)
-        if list(session.exec(statement)):
-            raise HTTPException(status_code=409, detail="The specified team name is not available.")
-        
-        team = Team(name=body.name, description=body.description)
-        session.add(team)
-        session.commit()
-        session.refresh(team)
-
-        member = TeamMember(team_id=team.id,
-                            user_id=user_id,
-                            invited_by=user_id,
-                            role=TeamRole.admin,
-                            accepted=False)
-        session.add(member)
-        session.commit()
-        session.refresh(team)
-        return team
+    user_id, user_team_ids = await verified_user_id_teams(token, session)
+    # Team.name is unique
+    team = Team(name=body.name, description=body.description)
+    session.add(team)
+    try:
+        await session.flush()     # assigns team.id
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="The specified team name is not available.")
+
+    member = TeamMember(team_id=team.id,
+                        user_id=user_id,
+                        invited_by=user_id,
+                        role=TeamRole.admin,
+                        accepted=False)
+    session.add(member)
+    await session.commit()
+    await session.refresh(team)
+    invalidate_user_teams(user_id)
+    return team
 
 
 
 @app.patch('/teams/{team_id}', response_model=Team)
-def patch_team(token:   str = Depends(token_auth_scheme),
-               team_id: int = Path(...),
-               body: TeamPatchRequest = ...) -> Team:
+async def patch_team(authz:   TeamAuthorization = Depends(TeamRoleRequired()),
+                     body: TeamPatchRequest = ...,
+                     session: AsyncSession = Depends(get_session)) -> Team:
     """
     Update Team
     """
     logger.info(body)
-    user_id, user_team_ids = verified_user_id_teams(token)
-    if team_id not in user_team_ids:
-        raise HTTPException(status_code=404, detail="Team not found")
-    with Session(engine) as session:    
-        team = session.get(Team, team_id)
-        if not team:
-            raise HTTPException(status_code=404, detail="Team not found")            
-
-        for key, value in body.dict(exclude_unset=True).items():
-            setattr(team, key, value)
-        team.updated_at = time()
-        session.add(team)
-        session.commit()
-        session.refresh(team)
-        return team
+    team = await session.get(Team, authz.team_id)
+    if not team:
+        raise HTTPException(status_code=404, detail="Team not found")            
+
+    for key, value in body.dict(exclude_unset=True).items():
+        setattr(team, key, value)
+    team.updated_at = timestamp_now()
+    session.add(team)
+    try:
+        await session.commit()
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="The specified team name is not available.")
+    return team
     
 
 
 
+def team_member_statement(*where):
+    """
+    select the TeamMembers matching the where clauses together with the member and inviter usernames.
+    The inviter username is None if the inviter's account has been deleted.
+    """
+    Member  = aliased(User)
+    Inviter = aliased(User)
+    return select(TeamMember, Member.username, Inviter.username) \
+        .join(Member,  Member.id  == TeamMember.user_id) \
+        .outerjoin(Inviter, Inviter.id == TeamMember.invited_by) \
+        .where(*where) \
+        .execution_options(populate_existing=True)   # timestamps as stored, also for members added by this session
+
+
+def team_member_response(row):
+    member, username, invited_by_username = row
+    return TeamMemberResponse(**member.dict(),
+                              username            = username,
+                              invited_by_username = invited_by_username)
+
+
+async def team_member_responses(session, *where, limit=None, cursor=None):
+    """
+    return TeamMemberResponses for the TeamMembers matching the where clauses (ordered by id and
+    paged by limit and cursor) and the cursor of the next page
+    """
+    statement = paginate(team_member_statement(*where), TeamMember.id, limit, cursor)
+    rows, next_cursor = page((await session.exec(statement)).all(), limit, lambda row: row[0].id)
+    return [team_member_response(row) for row in rows], next_cursor
+
+
 @app.get('/teams/{team_id}/members', response_model=GetTeamMembersResponse)
-def get_team_team_id_member(token: str = Depends(token_auth_scheme),
-                            team_id: int = Path(...)) -> GetTeamMembersResponse:
+async def get_team_team_id_member(token: str = Depends(token_auth_scheme),
+                                  team_id: int = Path(...),
+                                  limit:  Optional[int] = LimitQuery,
+                                  cursor: Optional[str] = CursorQuery,
+                                  session: AsyncSession = Depends(get_session)) -> GetTeamMembersResponse:
+    """
+    Get the members of the specified team, a page at a time if a limit is specified
+    """
+    user_id, user_team_ids = await verified_user_id_teams(token, session)
+    if team_id not in user_team_ids:
+        raise HTTPException(status_code=404, detail="Team not found")
+    members, next_cursor = await team_member_responses(session, TeamMember.team_id == team_id,
+                                                       limit=limit, cursor=cursor)
+    return GetTeamMembersResponse(items=members, next_cursor=next_cursor)
+
+
+@app.get('/teams/{team_id}/members/export')
+async def get_team_team_id_member_export(token: str = Depends(token_auth_scheme),
+                                         team_id: int = Path(...),
+                                         session: AsyncSession = Depends(get_session)):
     """
-    Get all members of the specified team
+    Stream all members of the specified team as newline delimited TeamMemberResponse JSON
     """
-    user_id, user_team_ids = verified_user_id_teams(token)
+    user_id, user_team_ids = await verified_user_id_teams(token, session)
     if team_id not in user_team_ids:
         raise HTTPException(status_code=404, detail="Team not found")
-    with Session(engine) as session:
-        members = []
-        for member in session.exec(select(TeamMember).where(TeamMember.team_id == team_id)):
-            tmr = TeamMemberResponse(**member.dict(),
-                                     username            = session.get(User, member.user_id).username,
-                                     invited_by_username = session.get(User, member.invited_by).username)
-            members.append(tmr)
-        return GetTeamMembersResponse(items=members)
+    statement = team_member_statement(TeamMember.team_id == team_id).order_by(TeamMember.id)
+    return ndjson_response(session, statement, team_member_response)
 
     
     
-        
+    
 @app.post('/teams/{team_id}/members', response_model=TeamMemberResponse)
-def post_team_member(token: str = Depends(token_auth_scheme),
-                     team_id: int = Path(...),
-                     body: TeamMemberPostRequest = ...) -> TeamMemberResponse:
-
+async def post_team_member(authz: TeamAuthorization = Depends(TeamRoleRequired(TeamRole.admin, TeamRole.member)),
+                           body: TeamMemberPostRequest = ...,
+                           session: AsyncSession = Depends(get_session)) -> TeamMemberResponse:
+    """
+    Add the specified user to the team.  Only admins may add admins.
+    """
     logger.info(body)
-    user_id, user_team_ids = verified_user_id_teams(token)
-    if team_id not in user_team_ids:
-        raise HTTPException(status_code=404, detail="Team not found")
-    with Session(engine) as session:    
-        team = session.get(Team, team_id)
-        if not team:
-            raise HTTPException(status_code=404, detail="Team not found")
-        
-        # verify calling user is a member of the specified team
-        statement = select(TeamMember).where(TeamMember.user_id == user_id, TeamMember.team_id == team_id)
-        user_member = session.exec(statement).first()
-        if not user_member:
-            raise HTTPException(status_code=404, detail="Team not found")
-
-        # verify user has sufficient permissions to add new user 
-        if user_member.role not in [TeamRole.admin, TeamRole.member]:
-            raise HTTPException(status_code=403, detail="Insufficient permissions to add member to the specified team.")
-
-        # verify new user exists
-        new_user = session.exec(select(User).where(User.username == body.username)).first()
-        if not new_user:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # Verify new user is not already a member of the team
-        statement = select(TeamMember).where(TeamMember.user_id == new_user.id, TeamMember.team_id == team_id)
-        if list(session.exec(statement)):
-            raise HTTPException(status_code=409, detail="User is already a member of the specified team.") 
-        
-        new_member = TeamMember(team_id=team.id,
-                                user_id=new_user.id,
-                                invited_by=user_id,
-                                role=TeamRole.admin,
-                                accepted=True)
-        session.add(new_member)
-        session.commit()
-        session.refresh(new_member)
-        return TeamMemberResponse(**new_member.dict(),
-                                  username            = new_user.username,
-                                  invited_by_username = session.get(User, user_id).username)
+    if body.role == TeamRole.admin and authz.role != TeamRole.admin:
+        raise HTTPException(status_code=403, detail="Insufficient permissions to add an admin to the specified team.")
+
+    # verify new user exists
+    new_user = (await session.exec(select(User).where(User.username == body.username))).first()
+    if not new_user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    # (user_id, team_id) is unique
+    new_member = TeamMember(team_id=authz.team_id,
+                            user_id=new_user.id,
+                            invited_by=authz.user_id,
+                            role=body.role,
+                            accepted=True)
+    session.add(new_member)
+    try:
+        await session.commit()
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="User is already a member of the specified team.") 
+    invalidate_user_teams(new_user.id)
+    members, _ = await team_member_responses(session, TeamMember.id == new_member.id)
+    return members[0]
+
+
+@app.patch('/teams/{team_id}/members', response_model=TeamMembersBatchResponse)
+async def patch_team_members(authz: TeamAuthorization = Depends(TeamRoleRequired()),
+                             body: TeamMembersBatchRequest = ...,
+                             session: AsyncSession = Depends(get_session)) -> TeamMembersBatchResponse:
+    """
+    Add, update and remove team members in one transaction.  Each operation is validated with the
+    permissions of the single member endpoints and reported separately; rejected operations do not
+    prevent the others from being applied.
+    """
+    caller_is_admin = authz.role == TeamRole.admin
+    names = list({item.username for item in body.items})
+
+    # resolve all usernames, then the existing memberships of those users in the team
+    statement = select(User.username, User.id).where(User.username.in_(names))
+    user_ids = dict(list(await session.exec(statement)))
+    statement = select(TeamMember).where(TeamMember.team_id == authz.team_id,
+                                         TeamMember.user_id.in_(list(user_ids.values())))
+    existing = {member.user_id: member for member in await session.exec(statement)}
+
+    results = [TeamMemberOperationResult(op=item.op, username=item.username, status=200) for item in body.items]
+
+    def reject(result, status, detail):
+        result.status = status
+        result.detail = detail
+
+    seen = set()
+    for item, result in zip(body.items, results):
+        user_id = user_ids.get(item.username)
+        member = existing.get(user_id)
+        if item.username in seen:
+            reject(result, 409, "Duplicate username in request.")
+        elif user_id is None:
+            reject(result, 404, "User not found")
+        elif item.op != TeamMemberOp.remove and item.role is None:
+            reject(result, 422, "A role is required.")
+        elif item.op == TeamMemberOp.add:
+            if member is not None:
+                reject(result, 409, "User is already a member of the specified team.")
+            elif authz.role not in (TeamRole.admin, TeamRole.member) or (item.role == TeamRole.admin and not caller_is_admin):
+                reject(result, 403, "Insufficient permissions to add member to the specified team.")
+        elif member is None:
+            reject(result, 404, "Team member not found")
+        elif item.op == TeamMemberOp.update and not caller_is_admin:
+            reject(result, 403, "Insufficient permission.")
+        elif item.op == TeamMemberOp.remove and not caller_is_admin and user_id != authz.user_id:
+            reject(result, 403, "Insufficient permission.")
+        seen.add(item.username)
+
+    applied = [(item, result, user_ids.get(item.username)) for item, result in zip(body.items, results) if result.status == 200]
+
+    # the team must keep an admin
+    demoted = [user_id for item, result, user_id in applied
+               if item.op != TeamMemberOp.add and existing[user_id].role == TeamRole.admin
+               and (item.op == TeamMemberOp.remove or item.role != TeamRole.admin)]
+    if demoted:
+        statement = select(func.count()).where(TeamMember.team_id == authz.team_id,
+                                               TeamMember.role == TeamRole.admin,
+                                               TeamMember.user_id.not_in(demoted))
+        new_admins = [user_id for item, result, user_id in applied if item.op != TeamMemberOp.remove and item.role == TeamRole.admin]
+        if (await session.exec(statement)).one() + len(new_admins) == 0:
+            for item, result, user_id in applied:
+                if user_id in demoted:
+                    reject(result, 403, "Team admin must designate another admin before removal.")
+            applied = [a for a in applied if a[1].status == 200]
+
+    now = timestamp_now()
+    adds = [{'team_id':    authz.team_id,
+             'user_id':    user_id,
+             'invited_by': authz.user_id,
+             'role':       item.role,
+             'accepted':   True,
+             'created_at': now,
+             'updated_at': now} for item, result, user_id in applied if item.op == TeamMemberOp.add]
+    if adds:
+        await session.exec(insert(TeamMember).values(adds))
+    updates = defaultdict(list)     # role -> [membership id]
+    for item, result, user_id in applied:
+        if item.op == TeamMemberOp.update:
+            updates[item.role].append(existing[user_id].id)
+    for role, ids in updates.items():
+        statement = update(TeamMember).where(TeamMember.id.in_(ids)).values(role=role, updated_at=now)
+        await session.exec(statement.execution_options(synchronize_session=False))
+    removes = [existing[user_id].id for item, result, user_id in applied if item.op == TeamMemberOp.remove]
+    if removes:
+        statement = delete(TeamMember).where(TeamMember.id.in_(removes))
+        await session.exec(statement.execution_options(synchronize_session=False))
+    try:
+        await session.commit()
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="Team membership changed concurrently; retry the request.")
+    changed = [user_id for item, result, user_id in applied]
+    invalidate_user_teams(*changed)
+
+    # report the added and updated memberships
+    kept = [user_id for item, result, user_id in applied if item.op != TeamMemberOp.remove]
+    if kept:
+        members, _ = await team_member_responses(session, TeamMember.team_id == authz.team_id, TeamMember.user_id.in_(kept))
+        members = {member.username: member for member in members}
+        for item, result, user_id in applied:
+            if item.op == TeamMemberOp.remove:
+                continue
+            result.member = members.get(item.username)
+            if result.member is None:
+                # removed by a concurrent request since this batch committed
+                reject(result, 404, "Team member not found")
+    return TeamMembersBatchResponse(items=results)
+
+
+async def team_member(session, authz, member_id):
+    """
+    return the specified TeamMember of the authorized team, raise 404 if there is none
+    """
+    member = await session.get(TeamMember, member_id)
+    if member is None or member.team_id != authz.team_id:
+        raise HTTPException(status_code=404, detail="Team member not found")
+    return member
+
+
+async def verify_other_admin(session, authz):
+    """
+    raise 403 if the authorized user is the only admin of the team
+    """
+    statement = select(func.count()).where(TeamMember.team_id == authz.team_id,
+                                           TeamMember.role == TeamRole.admin,
+                                           TeamMember.user_id != authz.user_id)
+    if (await session.exec(statement)).one() == 0:
+        raise HTTPException(status_code=403, detail="Team admin must designate another admin before removal.")
 
 
 @app.delete('/teams/{team_id}/members/{member_id}')
-def delete_team_member(token: str = Depends(token_auth_scheme),
-                       team_id: int = Path(...),
-                       member_id: int = Path(...)):
+async def delete_team_member(authz: TeamAuthorization = Depends(TeamRoleRequired()),
+                             member_id: int = Path(...),
+                             session: AsyncSession = Depends(get_session)):
     """
     remove  the specified member from the team
     """
-    user_id, user_team_ids = verified_user_id_teams(token)    
-    if team_id not in user_team_ids:
-        raise HTTPException(status_code=404, detail="Team not found")    
-    with Session(engine) as session:    
-        team = session.get(Team, team_id)
-        if not team:
-            raise HTTPException(status_code=404, detail="Team not found")
-
-        # verify calling user is a member of the specified team
-        statement = select(TeamMember).where(TeamMember.user_id == user_id, TeamMember.team_id == team_id)
-        user_member = session.exec(statement).first()
-        if not user_member:
-            raise HTTPException(status_code=404, detail="Team not found")  
-
-        # get user membership entry that is the target of the request
-        target_member = session.get(TeamMember, member_id)
-
-        # determine if the requesting user is the target of the membership entry
-        requesting_user_is_target = target_member.user_id == user_id
+    # get user membership entry that is the target of the request
+    target_member = await team_member(session, authz, member_id)
+
+    # determine if the requesting user is the target of the membership entry
+    requesting_user_is_target = target_member.user_id == authz.user_id
     
-        # determine if the requesting user is an admin of the target collection
-        requesting_user_is_admin = user_member.role == TeamRole.admin
+    # determine if the requesting user is an admin of the target collection
+    requesting_user_is_admin = authz.role == TeamRole.admin
     
-        # reject the delete operation unless the requesting user is the target of the entry (removing himself from the collection)
-        # or an admin of the target collection
-        if not requesting_user_is_target and not requesting_user_is_admin:
-            raise HTTPException(status_code=403, detail="Insufficient permission.")
+    # reject the delete operation unless the requesting user is the target of the entry (removing himself from the collection)
+    # or an admin of the target collection
+    if not requesting_user_is_target and not requesting_user_is_admin:
+        raise HTTPException(status_code=403, detail="Insufficient permission.")
 
-        # prevent removal of admin unless there is another admin specified for the team
-        if requesting_user_is_target and user_member.role == TeamRole.admin:
-            statement = select(TeamMember).where(TeamMember.role == TeamRole.admin, TeamMember.team_id == team_id)
-            num_admins = len(session.exec(statement))
-            if num_admins == 1:
-                raise HTTPException(status_code=403, detail="Team admin must designate another admin before removal.")
-        session.delete(target_member)
-        session.commit()
+    # prevent removal of admin unless there is another admin specified for the team
+    if requesting_user_is_target and requesting_user_is_admin:
+        await verify_other_admin(session, authz)
+    await session.delete(target_member)
+    await session.commit()
+    invalidate_user_teams(target_member.user_id)
 
 
 
 @app.patch('/teams/{team_id}/members/{member_id}', response_model=TeamMember)
-def patch_team_member(token:     str = Depends(token_auth_scheme),
-                      team_id:   int = Path(...),
-                      member_id: int = Path(...),
-                      body: TeamMemberPatchRequest = ...) -> TeamMember:
+async def patch_team_member(authz:     TeamAuthorization = Depends(TeamRoleRequired()),
+                            member_id: int = Path(...),
+                            body: TeamMemberPatchRequest = ...,
+                            session: AsyncSession = Depends(get_session)) -> TeamMember:
     
     """
     Change the role (admin only) or user's own accepted flag
     """
     logger.info(body)
-    user_id, user_team_ids = verified_user_id_teams(token)    
-    if team_id not in user_team_ids:
-        raise HTTPException(status_code=404, detail="Team not found")    
-    with Session(engine) as session:    
-        team = session.get(Team, team_id)
-        if not team:
-            raise HTTPException(status_code=404, detail="Team not found")
-
-        # verify calling user is a member of the specified team
-        statement = select(TeamMember).where(TeamMember.user_id == user_id, TeamMember.team_id == team_id)
-        user_member = session.exec(statement).first()
-        if not user_member:
-            raise HTTPException(status_code=404, detail="Team not found")
-
-        # get user membership entry that is the target of the request
-        target_member = session.get(TeamMember, member_id)
-
-        # reject change to role unless request made by admin
-        requesting_user_is_admin = user_member.role == TeamRole.admin        
-        if body.role is not None and not requesting_user_is_admin:
-            raise HTTPException(status_code=403, detail="Insufficient permission.")
-
-        # determine if the requesting user is the target of the membership entry
-        requesting_user_is_target = target_member.user_id == user_id
-
-        # disallow non-admin to change entries other than their own
-        if not requesting_user_is_target and not requesting_user_is_admin:
-            raise HTTPException(status_code=403, detail="Insufficient permission.")
-
-        target_member.update(body.dict(exclude_unset=True))
-        target_member.updated_at = time()
-        
-        session.commit()
-        session.refresh(target_member)
-        return(target_member)
-        
+    # get user membership entry that is the target of the request
+    target_member = await team_member(session, authz, member_id)
+
+    # reject change to role unless request made by admin
+    requesting_user_is_admin = authz.role == TeamRole.admin
+    if body.role is not None and not requesting_user_is_admin:
+        raise HTTPException(status_code=403, detail="Insufficient permission.")
+
+    # determine if the requesting user is the target of the membership entry
+    requesting_user_is_target = target_member.user_id == authz.user_id
+
+    # disallow non-admin to change entries other than their own
+    if not requesting_user_is_target and not requesting_user_is_admin:
+        raise HTTPException(status_code=403, detail="Insufficient permission.")
+
+    # prevent an admin from demoting themselves unless there is another admin
+    if requesting_user_is_target and body.role not in (None, TeamRole.admin):
+        await verify_other_admin(session, authz)
+
+    for key, value in body.dict(exclude_unset=True, exclude_none=True).items():
+        setattr(target_member, key, value)
+    target_member.updated_at = timestamp_now()
+    
+    await session.commit()
+    invalidate_user_teams(target_member.user_id)
+    return(target_member)
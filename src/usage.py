@@ -0,0 +1,80 @@
+# Write-behind tracking of API key usage
+# Copyright (C) 2022 William S. Kish
+#
+# /auth records when a key was used in memory; the buffered timestamps are
+# written with a single UPDATE per flush interval and at shutdown, keeping the
+# token issuing path free of write transactions.
+
+import threading
+from time import time, sleep, perf_counter
+
+from loguru import logger
+from sqlalchemy import case, update
+
+from models import ApiKey
+
+
+class LastUsedBuffer:
+    """
+    Coalesce ApiKey.last_used updates in memory and flush them to the database in bulk.
+    A key is not re-recorded while its stored last_used is within `precision` seconds.
+    """
+
+    def __init__(self, engine, interval=10, precision=60):
+        self.engine = engine
+        self.interval = interval
+        self.precision = precision
+        self.pending = {}      # apikey id -> last used timestamp
+        self.lock = threading.Lock()
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_errors = 0
+        self.last_flush_seconds = 0
+
+    def record(self, apikey):
+        now = time()
+        if apikey.last_used is not None and now - float(apikey.last_used) < self.precision:
+            return
+        with self.lock:
+            self.pending[apikey.id] = now
+
+    def flush(self):
+        """
+        write all pending last_used timestamps with one UPDATE statement
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        t0 = perf_counter()
+        statement = update(ApiKey).where(ApiKey.id.in_(list(pending))).values(last_used=case(pending, value=ApiKey.id))
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(statement)
+        except Exception as e:
+            self.flush_errors += 1
+            logger.warning(f"unable to flush {len(pending)} apikey last_used updates: {e}")
+            # retry with the next flush unless the keys were used again since
+            with self.lock:
+                for key_id, last_used in pending.items():
+                    self.pending.setdefault(key_id, last_used)
+            return
+        self.flushes += 1
+        self.flushed_rows += len(pending)
+        self.last_flush_seconds = perf_counter() - t0
+
+    def start(self):
+        thread = threading.Thread(target=self._flush_loop, name='apikey-last-used', daemon=True)
+        thread.start()
+
+    def _flush_loop(self):
+        while True:
+            sleep(self.interval)
+            self.flush()
+
+    def stats(self):
+        return {'pending':            len(self.pending),
+                'flushes':            self.flushes,
+                'flushed_rows':       self.flushed_rows,
+                'flush_errors':       self.flush_errors,
+                'last_flush_seconds': self.last_flush_seconds}
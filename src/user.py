@@ -4,16 +4,17 @@
 
 from __future__ import annotations
 from loguru import logger
-from sqlmodel import Session, select, delete
-from string import ascii_lowercase, ascii_uppercase
-from random import sample
+from sqlmodel import select, delete, or_
 from fastapi import Path, Query, Depends, HTTPException
+from sqlalchemy.exc import IntegrityError
 
 
 from main import app
 from auth import *
-from db import engine
+from db import AsyncSession, get_session
 from models import *
+from keygen import add_apikey
+from cache import TTLCache
 
 
 
@@ -22,7 +23,8 @@ from models import *
 ###
 
 @app.post('/users', response_model=User)
-def post_users(token: str = Depends(token_auth_scheme), body: UserPostRequest = ...) -> User:
+async def post_users(token: str = Depends(token_auth_scheme), body: UserPostRequest = ...,
+                     session: AsyncSession = Depends(get_session)) -> User:
     """
     Create new User and associate it with the auth0 token used to authenticate this call.
     This can only be called by a frontend user authenticated via auth0;
@@ -30,102 +32,146 @@ def post_users(token: str = Depends(token_auth_scheme), body: UserPostRequest =
     """
     logger.info(body)
 
-    token_payload = verify_auth0_token(token.credentials)
+    token_payload = await run_in_threadpool(verify_auth0_token, token.credentials)
     auth0_id = token_payload['sub']
-    with Session(engine) as session:
-        # verify auth0 id does not exist
-        statement = select(User).where(User.auth0_userid == auth0_id)
-        if session.exec(statement).first():
-            raise HTTPException(status_code=400, detail="The authenticated user already exists.")
 
-        statement = select(User).where(User.username == body.username)
-        if list(session.exec(statement)):
-            raise HTTPException(status_code=409, detail="The specified username is not available.")
+    # the user, their own team, membership and first key are created in one transaction.
+    # unique constraints on User.auth0_userid, User.username and Team.name reject duplicates,
+    # including concurrent signups.
+    try:
         # create user's own team
         team = Team(name=body.username)
         session.add(team)
-        session.commit()
-        session.refresh(team)
+        await session.flush()     # assigns team.id
 
-        # create user's object, with default team of his own team        
+        # create user's object, with default team of his own team
         user = User(**body.dict(exclude_unset=True),
                     default_team_id=team.id,
                     auth0_userid = auth0_id)
-        
         session.add(user)
-        session.commit()
-        session.refresh(user)
+        await session.flush()     # assigns user.id
+        session.info['user_id'] = user.id    # pins the new user's reads to the primary on commit
+
         # Add user as member of his own team
         member = TeamMember(team_id=team.id,
                             user_id=user.id,
                             invited_by=user.id,
                             role=TeamRole.admin,
                             accepted=True)
-
         session.add(member)
 
         # create apikey for user
-        key = ApiKey(user_id = user.id,
-                     description = "Autogenerated user key",
-                     key = "jgy-" + "".join([sample(ascii_lowercase+ascii_uppercase,1)[0] for x in range(42)]))
-        session.add(key)
-        session.commit()
-        session.refresh(user)        
-        return user
+        await add_apikey(session, user.id, "Autogenerated user key")
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        statement = select(User.id).where(User.auth0_userid == auth0_id)
+        if (await session.exec(statement)).first():
+            raise HTTPException(status_code=400, detail="The authenticated user already exists.")
+        raise HTTPException(status_code=409, detail="The specified username is not available.")
+    invalidate_user_teams(user.id)
+    return user
 
 
 
 @app.patch('/users/{user_id}', response_model=User)
-def patch_users(token:   str = Depends(token_auth_scheme),
-               user_id: int = Path(...),
-               body: UserPatchRequest = ...) -> User:
+async def patch_users(token:   str = Depends(token_auth_scheme),
+                     user_id: int = Path(...),
+                     body: UserPatchRequest = ...,
+                     session: AsyncSession = Depends(get_session)) -> User:
     """
     Update User
     """
     logger.info(body)
-    token_user_id = verified_user_id(token)    
+    token_user_id = await verified_user_id(token, session)    
     if token_user_id != user_id:
         raise HTTPException(status_code=401, detail="Authenticated user does not match the requested user_id")
-    with Session(engine) as session:    
-        user = session.get(User, user_id)
-        for key, value in body.dict(exclude_unset=True).items():
-            setattr(user, key, value)
-        #user.updated_at = time()
-        session.add(user)
-        session.commit()
-        session.refresh(user)
-        return user
+    user = await session.get(User, user_id)
+    for key, value in body.dict(exclude_unset=True).items():
+        setattr(user, key, value)
+    user.updated_at = timestamp_now()
+    session.add(user)
+    try:
+        await session.commit()
+    except IntegrityError:
+        raise HTTPException(status_code=409, detail="The specified username is not available.")
+    invalidate_username(user_id)
+    await session.refresh(user)
+    return user
+
+
+# user id -> username, for resolving users in bulk.  Evicted in all workers when a user is renamed or deleted.
+USERNAME_CACHE_SIZE = int(os.environ.get('JIGGY_USERNAME_CACHE_SIZE', 10000))
+USERNAME_CACHE_TTL  = int(os.environ.get('JIGGY_USERNAME_CACHE_TTL', 3600))
+
+usernames = TTLCache(maxsize=USERNAME_CACHE_SIZE, ttl=USERNAME_CACHE_TTL)
+
+bus.subscribe('username', usernames.pop)
+bus.subscribe('user', usernames.pop)
+bus.on_reset(usernames.clear)
+
+
+@app.post('/users/resolve', response_model=UserResolveResponse)
+async def post_users_resolve(token: str = Depends(token_auth_scheme),
+                             body: UserResolveRequest = ...,
+                             session: AsyncSession = Depends(get_session)) -> UserResolveResponse:
+    """
+    return the id and username of each of the specified users (by id or username) that is a member of
+    one of the caller's teams, using a single query.
+    """
+    user_id, user_team_ids = await verified_user_id_teams(token, session)
+    user_ids = list(set(body.user_ids))
+    names = list(set(body.usernames))
+    if not user_ids and not names:
+        return UserResolveResponse(items=[])
+    # users visible to the caller
+    members = select(TeamMember.user_id).where(TeamMember.team_id.in_(user_team_ids))
+
+    cached = {i: usernames.get(i) for i in user_ids}
+    if not names and None not in cached.values():
+        # only the visibility check is needed
+        statement = select(TeamMember.user_id).distinct().where(TeamMember.team_id.in_(user_team_ids),
+                                                                TeamMember.user_id.in_(user_ids))
+        items = [UserSummary(id=i, username=cached[i]) for i in await session.exec(statement)]
+    else:
+        statement = select(User.id, User.username).where(User.id.in_(members),
+                                                         or_(User.id.in_(user_ids), User.username.in_(names)))
+        items = [UserSummary(id=i, username=username) for i, username in await session.exec(statement)]
+        for item in items:
+            usernames.set(item.id, item.username)
+    return UserResolveResponse(items=sorted(items, key=lambda item: item.id))
 
 
 @app.get('/users/current', response_model=User)
-def get_users_current(token: str = Depends(token_auth_scheme)) -> User:
+async def get_users_current(token: str = Depends(token_auth_scheme),
+                            session: AsyncSession = Depends(get_session)) -> User:
     """
     return the authenticated user
     """
-    user_id = verified_user_id(token)
-    with Session(engine) as session:
-        return session.get(User, user_id)
+    user_id = await verified_user_id(token, session)
+    return await session.get(User, user_id)
 
 
 
 
 
 @app.delete('/users/{user_id}')
-def delete_users_user_id(token:   str = Depends(token_auth_scheme),
-                         user_id: int = Path(...)):
+async def delete_users_user_id(token:   str = Depends(token_auth_scheme),
+                               user_id: int = Path(...),
+                               session: AsyncSession = Depends(get_session)):
     """
     Delete specified user
     """
-    token_user_id = verified_user_id(token)
+    token_user_id = await verified_user_id(token, session)
     if int(token_user_id) != int(user_id):
         raise HTTPException(status_code=401, detail="Authenticated user does not match the requested user_id")
     
-    with Session(engine) as session:
-        user = session.get(User, user_id)
-        logger.info(user)
-        session.exec(delete(TeamMember).where(TeamMember.user_id == user_id))
-        session.exec(delete(ApiKey).where(ApiKey.user_id == user_id))
-        # session.exec(delete(Team).where(Team.name == user.username))  # XXX consider delete team consequences
-        session.delete(user)
-        session.commit()
+    user = await session.get(User, user_id)
+    logger.info(user)
+    await session.exec(delete(TeamMember).where(TeamMember.user_id == user_id))
+    await session.exec(delete(ApiKey).where(ApiKey.user_id == user_id))
+    # session.exec(delete(Team).where(Team.name == user.username))  # XXX consider delete team consequences
+    await session.delete(user)
+    await session.commit()
+    invalidate_user(user_id)
 
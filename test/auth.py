@@ -5,6 +5,7 @@
 import requests
 from os import environ
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 
 AUTH0_CLIENT_ID=environ['JIGGY_AUTH0_CLIENT_ID']
@@ -54,8 +55,14 @@ if r.status_code == 200:
     assert(r.status_code==200)
 
 
-r = s.post("/users", json={'username': "foobar"})
-assert(r.status_code == 200)
+# concurrent signups of the same user: exactly one succeeds
+with ThreadPoolExecutor(8) as executor:
+    responses = list(executor.map(lambda i: s.post("/users", json={'username': "foobar"}), range(8)))
+codes = sorted(r.status_code for r in responses)
+print(codes)
+assert(codes.count(200) == 1)
+assert(set(codes) <= {200, 400, 409})
+r = [r for r in responses if r.status_code == 200][0]
 print(r.json())
 
 r = s.post("/apikey", json={'description':'mykey'})
@@ -68,10 +75,16 @@ key = apikey['key']
 r = s.post("/auth", json={'key':key})
 assert(r.status_code == 200)
 print(r.json())
+refresh_token = r.json()['refresh_token']
+
+r = s.post("/auth/refresh", json={'refresh_token': refresh_token})
+assert(r.status_code == 200)
+assert(r.json()['refresh_token'] is None)
 
 
 r = s.get("/apikey")
 assert(r.status_code == 200)
+assert(r.headers['x-db-checkouts'] == '1')
 
 for k in r.json()['items']:
     print(k)
@@ -83,6 +96,10 @@ r = s.get("/apikey")
 assert(r.status_code == 200)
 assert(len(r.json()['items']) == 0)
 
+# the refresh token of a deleted key is revoked
+r = s.post("/auth/refresh", json={'refresh_token': refresh_token})
+assert(r.status_code == 401)
+
 
 ##
 ## Team
@@ -90,6 +107,8 @@ assert(len(r.json()['items']) == 0)
 
 r = s.get("/teams")
 assert(r.status_code == 200)
+# the auth helpers and the endpoint share a single pooled connection
+assert(r.headers['x-db-checkouts'] == '1')
 teams = r.json()['items']
 assert(len(teams) == 1)
 assert(teams[0]['id'] == s.get("/users/current").json()['default_team_id'])
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3.9
+
+# benchmark POST /users/import: uploads --rows synthetic users as a streamed NDJSON (or --csv) body
+# while reading the streamed results, and reports the import progress and throughput in rows/sec.
+# The key must belong to a user listed in the server's JIGGY_ADMIN_USER_IDS.  The imported users,
+# their teams, memberships and keys are removed afterwards directly in the database (JIGGY_POSTGRES_*
+# environment).
+#
+#   bench_import.py LOCAL --key jgy2-... --rows 100000
+
+import json
+from http.client import HTTPConnection, HTTPSConnection
+from threading import Thread
+from time import perf_counter, time
+from urllib.parse import urlsplit
+
+import live
+from sqlmodel import Session, select, delete
+from db import engine
+from models import User, Team, TeamMember, ApiKey
+
+
+parser = live.argument_parser("API key of an admin user")
+parser.add_argument('--rows', type=int, default=100000)
+parser.add_argument('--csv', action='store_true', help="upload CSV instead of NDJSON")
+args = parser.parse_args()
+
+url, headers = live.connect(args)
+
+prefix = f"bi{int(time()) % 100000}-"
+
+
+def body():
+    if args.csv:
+        yield b"username,auth0_userid\n"
+    for start in range(0, args.rows, 10000):
+        if args.csv:
+            lines = [f"{prefix}{i},\n" for i in range(start, min(start + 10000, args.rows))]
+        else:
+            lines = [json.dumps({'username': f"{prefix}{i}"}) + "\n" for i in range(start, min(start + 10000, args.rows))]
+        yield "".join(lines).encode()
+
+
+if args.csv:
+    headers['content-type'] = 'text/csv'
+else:
+    headers['content-type'] = 'application/x-ndjson'
+
+
+def post_streaming(path, headers, body):
+    """
+    POST the body chunks with chunked transfer encoding from a thread while the response is read,
+    so that results are received as the server commits them
+    """
+    parts = urlsplit(url + path)
+    connection_class = HTTPSConnection if parts.scheme == 'https' else HTTPConnection
+    conn = connection_class(parts.netloc)
+    conn.putrequest('POST', parts.path)
+    for name, value in headers.items():
+        conn.putheader(name, value)
+    conn.putheader('Transfer-Encoding', 'chunked')
+    conn.endheaders()
+
+    def upload():
+        for data in body:
+            conn.send(b"%X\r\n%s\r\n" % (len(data), data))
+        conn.send(b"0\r\n\r\n")
+
+    Thread(target=upload, daemon=True).start()
+    return conn.getresponse()
+
+
+try:
+    t0 = perf_counter()
+    created = errors = 0
+    r = post_streaming('/users/import', headers, body())
+    assert(r.status == 200)
+    for line in r:
+        result = json.loads(line)
+        if 'done' in result:
+            done = result['done']
+        elif 'progress' in result:
+            print(f"{result['progress']['rows']} rows after {perf_counter() - t0:.1f}s")
+        elif 'apikey' in result:
+            created += 1
+        elif 'error' in result:
+            errors += 1
+    elapsed = perf_counter() - t0
+    print(f"{created} users created, {errors} errors in {elapsed:.1f}s: {args.rows / elapsed:.0f} rows/sec "
+          f"(server {done['rows_per_second']:.0f} rows/sec)")
+    assert(created == args.rows)
+finally:
+    with Session(engine) as session:
+        synthetic = select(User.id).where(User.username.startswith(prefix))
+        session.exec(delete(ApiKey).where(ApiKey.user_id.in_(synthetic)).execution_options(synchronize_session=False))
+        session.exec(delete(TeamMember).where(TeamMember.user_id.in_(synthetic)).execution_options(synchronize_session=False))
+        session.exec(delete(User).where(User.username.startswith(prefix)).execution_options(synchronize_session=False))
+        session.exec(delete(Team).where(Team.name.startswith(prefix)).execution_options(synchronize_session=False))
+        session.commit()
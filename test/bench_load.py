@@ -0,0 +1,66 @@
+#!/usr/bin/env python3.9
+
+# load test an authenticated read endpoint at high concurrency and report requests/sec and latency percentiles.
+# run against a server before and after a change to compare, e.g.
+#
+#   bench_load.py LOCAL --key jgy2-... --concurrency 200 --requests 20000 --path /teams
+
+import argparse
+import asyncio
+from time import perf_counter
+
+import httpx
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('target', nargs='?', default='LOCAL', help="LOCAL or a base url")
+parser.add_argument('--key', required=True, help="API key used to obtain a bearer token")
+parser.add_argument('--path', default='/users/current')
+parser.add_argument('--concurrency', type=int, default=200)
+parser.add_argument('--requests', type=int, default=10000)
+args = parser.parse_args()
+
+if args.target == 'LOCAL':
+    host = 'http://127.0.0.1:8000'
+else:
+    host = args.target
+
+prefix = "jiggyuser-v0"
+
+
+async def worker(client, remaining, latencies, errors):
+    while remaining:
+        remaining.pop()
+        t0 = perf_counter()
+        r = await client.get(args.path)
+        latencies.append(perf_counter() - t0)
+        if r.status_code != 200:
+            errors.append(r.status_code)
+
+
+async def main():
+    base_url = f"{host}/{prefix}"
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        r = await client.post("/auth", json={'key': args.key})
+        assert(r.status_code == 200)
+        token = r.json()['jwt']
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url,
+                                 headers={"authorization": "Bearer %s" % token},
+                                 limits=limits,
+                                 timeout=60) as client:
+        remaining = list(range(args.requests))
+        latencies = []
+        errors = []
+        t0 = perf_counter()
+        await asyncio.gather(*[worker(client, remaining, latencies, errors) for _ in range(args.concurrency)])
+        elapsed = perf_counter() - t0
+
+    latencies.sort()
+    pct = lambda p: latencies[min(len(latencies)-1, int(p * len(latencies)))] * 1000
+    print(f"{args.path} concurrency {args.concurrency}: {len(latencies)/elapsed:.0f} req/s  "
+          f"p50 {pct(.5):.1f}ms  p99 {pct(.99):.1f}ms  errors {len(errors)}")
+
+
+asyncio.run(main())
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3.9
+
+# benchmark the per-request cost of verifying auth0-issued tokens:
+# the previous try-jiggy-then-fall-back-to-auth0 path versus issuer dispatch.
+# run from the src directory with the usual JIGGY_* environment configured.
+
+import sys
+from time import time, perf_counter
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+sys.path.insert(0, '.')
+import auth
+import keys
+
+
+N = 2000
+
+# stand in for auth0's signing key so no network access is needed
+auth0_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+class LocalJWKClient:
+    class SigningKey:
+        key = auth0_key.public_key()
+    def get_signing_key(self, kid):
+        return self.SigningKey
+    def get_signing_key_from_jwt(self, token):
+        return self.SigningKey
+
+auth.jwks_client = LocalJWKClient()
+
+active_pem = keys.ACTIVE_PUBLIC_KEY.public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+iat = int(time())
+token = jwt.encode({'iat': iat,
+                    'exp': iat + 15*60,
+                    'iss': auth.ISSUER,
+                    'aud': auth.API_AUDIENCE,
+                    'sub': 'auth0|bench'},
+                   auth0_key, algorithm='RS256', headers={'kid': 'bench'})
+
+
+def fallback_verify(credentials):
+    # the previous verified_user_id behavior, including parsing the PEM key for every token
+    try:
+        return jwt.decode(credentials, active_pem,
+                          algorithms=[keys.SIGNING_ALGORITHM], issuer=auth.JWT_ISSUER)
+    except:
+        return auth.verify_auth0_token(credentials)
+
+
+def bench(name, fn):
+    fn(token)
+    t0 = perf_counter()
+    for _ in range(N):
+        fn(token)
+    per_call = (perf_counter() - t0) / N
+    print(f"{name:20s} {per_call*1e6:8.1f} us/token")
+    return per_call
+
+
+before = bench("fallback", fallback_verify)
+after  = bench("issuer dispatch", auth.verify_token)
+print(f"speedup {before/after:.2f}x")
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3.9
+
+# check that the queries on the authentication and authorization hot paths are served by indexes.
+# Runs EXPLAIN for each query against the database in the JIGGY_POSTGRES_* environment (migrated
+# with python db.py) and fails if a plan reads a table with a sequential scan.  Sequential scans are
+# disabled for the check since small test tables would otherwise never be read through an index.
+#
+#   explain_indexes.py
+
+import json
+import sys
+from os.path import dirname, join
+
+sys.path.insert(0, join(dirname(__file__), '..', 'src'))
+from sqlalchemy import func, text
+from sqlalchemy.dialects import postgresql
+from sqlmodel import select
+from db import engine
+from models import User, Team, TeamMember, TeamRole, ApiKey
+
+
+HOT_QUERIES = {
+    'membership of user in team': select(TeamMember).where(TeamMember.user_id == 1, TeamMember.team_id == 1),
+    'teams of user':              select(TeamMember.team_id).where(TeamMember.user_id == 1),
+    'team admin count':           select(func.count()).where(TeamMember.team_id == 1, TeamMember.role == TeamRole.admin),
+    'members of team':            select(TeamMember).where(TeamMember.team_id == 1).order_by(TeamMember.id),
+    'user by username':           select(User).where(User.username == 'foobar'),
+    'user by auth0 id':           select(User).where(User.auth0_userid == 'auth0|foobar'),
+    'team by name':               select(Team).where(Team.name == 'foobar'),
+    'apikey by id':               select(ApiKey).where(ApiKey.id == 1),
+    'apikeys of user':            select(ApiKey).where(ApiKey.user_id == 1).order_by(ApiKey.id),
+}
+
+
+def plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+failed = False
+with engine.connect() as conn:
+    conn.execute(text('SET enable_seqscan = off'))
+    for name, statement in HOT_QUERIES.items():
+        sql = statement.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True})
+        plan = conn.execute(text(f'EXPLAIN (FORMAT JSON) {sql}')).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        nodes = list(plan_nodes(plan[0]['Plan']))
+        scans = [f"{n['Node Type']} {n.get('Index Name', n.get('Relation Name', ''))}".strip()
+                 for n in nodes if 'Scan' in n['Node Type']]
+        ok = not any(n['Node Type'] == 'Seq Scan' for n in nodes)
+        failed |= not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {name}: {', '.join(scans)}")
+
+assert(not failed)
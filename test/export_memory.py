@@ -0,0 +1,76 @@
+#!/usr/bin/env python3.9
+
+# regression test: streaming the member export of a large team must not grow the server's memory.
+# Seeds --rows synthetic members into the key owner's default team directly in the database
+# (JIGGY_POSTGRES_* environment), streams GET /teams/{team_id}/members/export and compares the
+# server's peak RSS (from /stats, so run the server with JIGGY_STATS_ENDPOINT=1) before and after.
+# Every member of the team must be exported, including those whose inviter has been deleted.
+# The seeded rows are removed afterwards.
+#
+#   export_memory.py LOCAL --key jgy2-... --rows 200000
+
+from time import perf_counter
+
+import requests
+
+import live
+from sqlmodel import Session, select, insert, delete, func
+from db import engine
+from models import User, TeamMember, TeamRole
+
+
+parser = live.argument_parser("API key of a member of the team to export")
+parser.add_argument('--rows', type=int, default=200000)
+parser.add_argument('--max-growth-mb', type=int, default=32)
+args = parser.parse_args()
+
+url, headers = live.connect(args)
+
+r = requests.get(f"{url}/users/current", headers=headers)
+assert(r.status_code == 200)
+user_id = r.json()['id']
+team_id = r.json()['default_team_id']
+
+
+def max_rss_kb():
+    r = requests.get(f"{url}/stats")
+    assert(r.status_code == 200)
+    return r.json()['max_rss_kb']
+
+
+prefix = f"em-{team_id}-"
+try:
+    with Session(engine) as session:
+        for start in range(0, args.rows, 10000):
+            names = [f"{prefix}{i}" for i in range(start, min(start + 10000, args.rows))]
+            session.exec(insert(User).values([{'username': n, 'default_team_id': team_id} for n in names]))
+            ids = session.exec(select(User.id).where(User.username.in_(names))).all()
+            # some inviters have deleted their accounts (there is no user 0); their invitees are still exported
+            session.exec(insert(TeamMember).values([{'team_id': team_id, 'user_id': i, 'invited_by': 0 if i % 10 == 0 else user_id,
+                                                     'role': TeamRole.view, 'accepted': True}
+                                                    for i in ids]))
+        session.commit()
+        members = session.exec(select(func.count()).where(TeamMember.team_id == team_id)).one()
+    print(f"seeded {args.rows} members")
+
+    before = max_rss_kb()
+    t0 = perf_counter()
+    first_byte = None
+    lines = 0
+    with requests.get(f"{url}/teams/{team_id}/members/export", headers=headers, stream=True) as r:
+        assert(r.status_code == 200)
+        for line in r.iter_lines():
+            if first_byte is None:
+                first_byte = perf_counter() - t0
+            lines += 1
+    elapsed = perf_counter() - t0
+    growth_mb = (max_rss_kb() - before) / 1024
+    print(f"{lines} lines in {elapsed:.1f}s, first line after {first_byte*1000:.0f}ms, peak rss growth {growth_mb:.1f}MB")
+    assert(lines == members)
+    assert(growth_mb < args.max_growth_mb)
+finally:
+    with Session(engine) as session:
+        synthetic = select(User.id).where(User.username.startswith(prefix))
+        session.exec(delete(TeamMember).where(TeamMember.user_id.in_(synthetic)).execution_options(synchronize_session=False))
+        session.exec(delete(User).where(User.username.startswith(prefix)).execution_options(synchronize_session=False))
+        session.commit()
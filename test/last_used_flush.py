@@ -0,0 +1,85 @@
+#!/usr/bin/env python3.9
+
+# regression test: apikey last_used updates made by /auth are coalesced into one UPDATE per flush.
+# Creates --keys API keys for the key owner, backdates their last_used directly in the database
+# (JIGGY_POSTGRES_* environment) so that every use is recorded, makes --calls /auth calls spread over
+# the keys and waits for the write-behind flush.  The flush and row counters from /stats (run the
+# server with JIGGY_STATS_ENDPOINT=1) must show one flush of one row per key.  The keys are deleted afterwards.
+#
+#   last_used_flush.py LOCAL --key jgy2-... --calls 200
+
+from time import sleep, perf_counter
+
+import requests
+
+import live
+from sqlmodel import Session, update
+from db import engine
+from models import ApiKey
+
+
+parser = live.argument_parser("API key of the user to test with")
+parser.add_argument('--keys', type=int, default=5)
+parser.add_argument('--calls', type=int, default=200)
+parser.add_argument('--timeout', type=int, default=60, help="seconds to wait for a flush")
+args = parser.parse_args()
+
+url, headers = live.connect(args)
+
+
+def flush_stats():
+    r = requests.get(f"{url}/stats")
+    assert(r.status_code == 200)
+    return r.json()['apikey_last_used']
+
+
+def next_flush(flushes):
+    """
+    wait for the flush following the specified flush count and return the stats after it
+    """
+    t0 = perf_counter()
+    while perf_counter() - t0 < args.timeout:
+        stats = flush_stats()
+        if stats['flushes'] > flushes:
+            return stats
+        sleep(0.1)
+    raise AssertionError("no apikey last_used flush within the timeout")
+
+
+def backdate(key_ids):
+    """
+    make the keys' last_used old enough for their next use to be recorded
+    """
+    with Session(engine) as session:
+        session.exec(update(ApiKey).where(ApiKey.id.in_(key_ids)).values(last_used=0))
+        session.commit()
+
+
+key_ids = []
+try:
+    keys = []
+    for i in range(args.keys):
+        r = requests.post(f"{url}/apikey", headers=headers, json={'description': 'last_used_flush'})
+        assert(r.status_code == 200)
+        keys.append(r.json()['key'])
+        key_ids.append(r.json()['id'])
+
+    # start right after a flush so that all the calls are coalesced into the next one
+    backdate(key_ids)
+    stats = flush_stats()
+    requests.post(f"{url}/auth", json={'key': keys[0]})
+    before = next_flush(stats['flushes'])
+    backdate(key_ids)
+
+    for i in range(args.calls):
+        r = requests.post(f"{url}/auth", json={'key': keys[i % len(keys)]})
+        assert(r.status_code == 200)
+    after = next_flush(before['flushes'])
+    print(f"{args.calls} /auth calls with {len(keys)} keys: {after['flushes'] - before['flushes']} flush of "
+          f"{after['flushed_rows'] - before['flushed_rows']} rows in {after['last_flush_seconds']*1000:.1f}ms")
+    assert(after['flushes'] - before['flushes'] == 1)
+    assert(after['flushed_rows'] - before['flushed_rows'] == len(keys))
+    assert(after['flush_errors'] == before['flush_errors'])
+finally:
+    for key_id in key_ids:
+        requests.delete(f"{url}/apikey/{key_id}", headers=headers)
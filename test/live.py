@@ -0,0 +1,36 @@
+# common setup of the test scripts that run against a live server and its database.
+# Importing this module puts src/ on the path, so scripts can use db and models directly
+# with the JIGGY_POSTGRES_* environment of the server.
+
+import argparse
+import sys
+from os.path import dirname, join
+
+import requests
+
+sys.path.insert(0, join(dirname(__file__), '..', 'src'))
+
+
+def argument_parser(key_help):
+    """
+    return an ArgumentParser for the target (LOCAL or a base url) and --key arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('target', nargs='?', default='LOCAL', help="LOCAL or a base url")
+    parser.add_argument('--key', required=True, help=key_help)
+    return parser
+
+
+def connect(args):
+    """
+    return the API url of the target and the authorization headers of a JWT for the key
+    """
+    if args.target == 'LOCAL':
+        host = 'http://127.0.0.1:8000'
+    else:
+        host = args.target
+    url = f"{host}/jiggyuser-v0"
+
+    r = requests.post(f"{url}/auth", json={'key': args.key})
+    assert(r.status_code == 200)
+    return url, {"authorization": "Bearer %s" % r.json()['jwt']}
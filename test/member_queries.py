@@ -0,0 +1,68 @@
+#!/usr/bin/env python3.9
+
+# regression test: the number of database queries made by GET /teams/{team_id}/members (reported in
+# X-DB-Queries) must not grow with the size of the team, and members whose inviter has been deleted
+# must still be listed.  Synthetic members are added to the key owner's default team directly in the
+# database (JIGGY_POSTGRES_* environment) and removed afterwards.
+#
+#   member_queries.py LOCAL --key jgy2-...
+
+import requests
+
+import live
+from sqlmodel import Session, delete, update
+from db import engine
+from models import User, TeamMember, TeamRole
+
+
+parser = live.argument_parser("API key of an admin of the team to test")
+args = parser.parse_args()
+
+url, headers = live.connect(args)
+
+r = requests.get(f"{url}/users/current", headers=headers)
+assert(r.status_code == 200)
+user_id = r.json()['id']
+team_id = r.json()['default_team_id']
+
+
+def member_queries():
+    r = requests.get(f"{url}/teams/{team_id}/members", headers=headers)
+    assert(r.status_code == 200)
+    return len(r.json()['items']), int(r.headers['x-db-queries'])
+
+
+synthetic_ids = []
+try:
+    counts = [member_queries()]
+    for size in [10, 100]:
+        with Session(engine) as session:
+            users = [User(username=f"mq-{team_id}-{len(synthetic_ids)+i}", default_team_id=team_id)
+                     for i in range(size - len(synthetic_ids))]
+            session.add_all(users)
+            session.flush()
+            session.add_all([TeamMember(team_id=team_id, user_id=u.id, invited_by=user_id, role=TeamRole.view, accepted=True)
+                             for u in users])
+            session.commit()
+            synthetic_ids += [u.id for u in users]
+        counts.append(member_queries())
+    print("members, queries:", counts)
+    assert(len(set(queries for members, queries in counts)) == 1)
+
+    # members invited by a user who has since deleted their account are still listed
+    inviter_id, invitee_id = synthetic_ids[:2]
+    with Session(engine) as session:
+        session.exec(update(TeamMember).where(TeamMember.user_id == invitee_id).values(invited_by=inviter_id))
+        session.exec(delete(TeamMember).where(TeamMember.user_id == inviter_id))
+        session.exec(delete(User).where(User.id == inviter_id))
+        session.commit()
+    r = requests.get(f"{url}/teams/{team_id}/members", headers=headers)
+    assert(r.status_code == 200)
+    invitee = [m for m in r.json()['items'] if m['username'] == f"mq-{team_id}-1"]
+    assert(len(invitee) == 1 and invitee[0]['invited_by_username'] is None)
+    assert(len(r.json()['items']) == counts[-1][0] - 1)
+finally:
+    with Session(engine) as session:
+        session.exec(delete(TeamMember).where(TeamMember.user_id.in_(synthetic_ids)))
+        session.exec(delete(User).where(User.id.in_(synthetic_ids)))
+        session.commit()